@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Benchmark `includex` on synthetic corpora.
+
+Each scenario renders a mix of includes repeatedly and reports throughput, per-call latency
+(p50/p99) and peak memory. Results can be written to a JSON file and compared against a
+previously stored baseline:
+
+```sh
+python benchmarks/bench_includex.py --output baseline.json
+# ... change something ...
+python benchmarks/bench_includex.py --baseline baseline.json
+```
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import includex  # noqa: E402
+
+PYTHON_SNIPPET = '''\
+import os
+
+
+class Example{i}:
+    """An example class."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def method(self, other):
+        # compute something `interesting`
+        return self.value * other
+
+
+def function_{i}(a, b):
+    return Example{i}(a).method(b)
+'''
+
+
+def create_corpus(directory: pathlib.Path, scale: float) -> dict[str, pathlib.Path]:
+    """Write synthetic files to *directory* and return their paths by name."""
+    paths = {}
+
+    big = directory / "big.log"
+    with big.open("w") as f:
+        for i in range(int(1_000_000 * scale)):
+            f.write(f"2023-11-08 12:00:{i % 60:02d} INFO [worker-{i % 8}] processed item {i}\n")
+    paths["big"] = big
+
+    small = directory / "small"
+    small.mkdir()
+    for i in range(max(1, int(1_000 * scale))):
+        (small / f"example_{i}.py").write_text(PYTHON_SNIPPET.format(i=i))
+    paths["small"] = small
+
+    markdown = directory / "doc.md"
+    with markdown.open("w") as f:
+        for i in range(int(10_000 * scale)):
+            f.write(f"## Section {i}\n\nSome *text* with `code` and {{{{ braces }}}}.\n\n")
+        f.write("## Last Section\n\nThe end.\n")
+    paths["markdown"] = markdown
+
+    return paths
+
+
+def scenarios(paths: dict[str, pathlib.Path], scale: float) -> dict[str, list[dict]]:
+    """Return calls to `includex` (as keyword arguments) for each scenario."""
+    last_item = int(1_000_000 * scale) - 10
+    small_files = sorted(paths["small"].iterdir())
+    return {
+        "big_file_head": [dict(filepath=paths["big"], lines=20)],
+        "big_file_tail": [dict(filepath=paths["big"], start=-30)],
+        "big_file_full": [dict(filepath=paths["big"])],
+        "small_files": [dict(filepath=p) for p in small_files],
+        "deep_match": [
+            dict(filepath=paths["markdown"], start_match="## Last Section", end_match="The end"),
+            dict(filepath=paths["big"], start_match=f"item {last_item}\n", lines=5),
+        ],
+        "escape_replace": [
+            dict(
+                filepath=paths["markdown"],
+                escape=["`", "*", "_", "{", "}"],
+                replace=[("Section", "Chapter"), ("text", "words"), ("code", "snippet")],
+                replace_notice=True,
+            )
+        ],
+        "code_inference": [dict(filepath=p, code=True) for p in small_files[:100]],
+        "raw_caption": [
+            dict(
+                filepath=p,
+                start_match="class",
+                end_match="def function",
+                raw=True,
+                code="py",
+                caption=True,
+            )
+            for p in small_files[:100]
+        ],
+    }
+
+
+def run_scenario(calls: list[dict], repeat: int) -> dict:
+    """Run *calls* *repeat* times (starting with an empty file cache) and collect statistics."""
+    includex.file_cache.clear()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for kwargs in calls:
+            t = time.perf_counter()
+            includex.includex(**kwargs)
+            latencies.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+
+    # measure memory separately, as tracing slows down execution considerably
+    includex.file_cache.clear()
+    tracemalloc.start()
+    for kwargs in calls:
+        includex.includex(**kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "calls": len(latencies),
+        "throughput": len(latencies) / total,
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "peak_memory_bytes": peak,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return descriptions of all scenarios that regressed compared to *baseline*."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("p50_ms", "p99_ms", "peak_memory_bytes"):
+            before, after = baseline[name][metric], result[metric]
+            if before and after > before * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {before:.4g} -> {after:.4g}")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scale", type=float, default=1.0, help="scale size of corpora")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions of each scenario")
+    parser.add_argument("-k", dest="select", default="", help="only run matching scenarios")
+    parser.add_argument("--output", type=pathlib.Path, help="write results to this JSON file")
+    parser.add_argument("--baseline", type=pathlib.Path, help="compare against this JSON file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="relative slowdown reported as regression"
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = create_corpus(pathlib.Path(tmp), args.scale)
+        results = {}
+        print(f"{'scenario':<16} {'calls/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'peak MiB':>10}")
+        for name, calls in scenarios(paths, args.scale).items():
+            if args.select not in name:
+                continue
+            results[name] = result = run_scenario(calls, args.repeat)
+            print(
+                f"{name:<16} {result['throughput']:>10.1f} {result['p50_ms']:>10.3f} "
+                f"{result['p99_ms']:>10.3f} {result['peak_memory_bytes'] / 2**20:>10.2f}"
+            )
+
+    if args.output:
+        args.output.write_text(
+            json.dumps(
+                {
+                    "version": includex.__version__,
+                    "python": platform.python_version(),
+                    "scale": args.scale,
+                    "repeat": args.repeat,
+                    "results": results,
+                },
+                indent=2,
+            )
+        )
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
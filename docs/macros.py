@@ -3,40 +3,118 @@
 See the [`mkdocs-macros-plugin` Documentation](https://mkdocs-macros-plugin.readthedocs.io/) for more information.
 """
 
+from __future__ import annotations
+
+import fnmatch
 import logging
 import os
 import pathlib
+from typing import TYPE_CHECKING, Iterator
 
-from mkdocs_macros.plugin import MacrosPlugin
+if TYPE_CHECKING:  # only needed for annotations, so this module can be tested without mkdocs
+    from mkdocs_macros.plugin import MacrosPlugin
 
 root = pathlib.Path(__file__).parent.parent.parent
 
 log = logging.getLogger("mkdocs.mkdocs_macros")
 
+_listings: dict[str, tuple[int, list[tuple[str, bool]]]] = {}
+"""Cached directory listings by path, see `_scandir`."""
+
 
 def define_env(env: MacrosPlugin):
     """Define variables, macros and filters for mkdocs-macros."""
     env.macro(get_files)
 
 
-def get_files(directory: str | pathlib.Path, match: str = "", ignore: str = "") -> list[str]:
+def get_files(
+    directory: str | pathlib.Path,
+    match: str = "",
+    ignore: str = "",
+    pattern: str = "",
+    recursive: bool = False,
+    lazy: bool = False,
+) -> list[pathlib.Path] | Iterator[pathlib.Path]:
     """Return list of files in *directory* that match the provided substring.
 
     Args:
         directory: path to directory
         match: only files that contain this string will be included
-        ignore: files containing this string won't be included
+        ignore: files (and, if *recursive*, directories) containing this string won't be included
+        pattern: only files matching this glob pattern (e.g. `*.md`) will be included
+
+            If the pattern contains a `/`, it is matched against the path relative to
+            *directory* (e.g. `api/*.md`, where `*` doesn't match `/`), otherwise against the
+            filename.
+
+        recursive: include files in subdirectories (subdirectories themselves are not included)
+
+            Symbolic links to directories are followed, unless they would lead into a loop.
+
+        lazy: return a generator instead of a list, so large trees are not held in memory
 
     Returns:
-        List of files in *directory*
+        List of files in *directory*, sorted by name
     """
-    rv = []
     directory = pathlib.Path(directory)
     assert directory.is_dir()
-    for file in sorted(os.listdir(directory)):
-        if match and match not in file:
+    files = _iter_files(directory, pathlib.PurePosixPath(), match, ignore, pattern, recursive)
+    return files if lazy else list(files)
+
+
+def _iter_files(
+    directory: pathlib.Path,
+    relative: pathlib.PurePosixPath,
+    match: str,
+    ignore: str,
+    pattern: str,
+    recursive: bool,
+    ancestors: frozenset[str] = frozenset(),
+) -> Iterator[pathlib.Path]:
+    if recursive:
+        real = os.path.realpath(directory)
+        if real in ancestors:
+            return  # symbolic link to a directory that is being listed already
+        ancestors |= {real}
+    for name, is_dir in _scandir(directory):
+        if ignore and ignore in name:
             continue
-        if ignore and ignore in file:
+        if recursive and is_dir:
+            yield from _iter_files(
+                directory / name, relative / name, match, ignore, pattern, recursive, ancestors
+            )
             continue
-        rv.append(directory / file)
-    return rv
+        if match and match not in name:
+            continue
+        if pattern and not (
+            _match_path((relative / name).parts, pattern)
+            if "/" in pattern
+            else fnmatch.fnmatch(name, pattern)
+        ):
+            continue
+        yield directory / name
+
+
+def _match_path(parts: tuple[str, ...], pattern: str) -> bool:
+    """Whether path *parts* match *pattern*, matching each part separately."""
+    pattern_parts = pattern.split("/")
+    return len(parts) == len(pattern_parts) and all(
+        fnmatch.fnmatch(part, part_pattern) for part, part_pattern in zip(parts, pattern_parts)
+    )
+
+
+def _scandir(directory: pathlib.Path) -> list[tuple[str, bool]]:
+    """Return sorted names of all entries in *directory* and whether they are directories.
+
+    Listings are cached until the modification time of *directory* changes.
+    """
+    key = str(directory)
+    mtime = os.stat(key).st_mtime_ns
+    cached = _listings.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with os.scandir(key) as entries:
+        # `DirEntry.is_dir` doesn't need another syscall on most platforms
+        listing = sorted((entry.name, entry.is_dir()) for entry in entries)
+    _listings[key] = (mtime, listing)
+    return listing
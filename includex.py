@@ -1,25 +1,96 @@
 from __future__ import annotations  # compatibility with
 
+import ast
+import atexit
+import bisect
+import codecs
+import collections
+import fnmatch
+import functools
+import glob
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import locale
+import mmap
 import os
 import pathlib
+import re
+import select
+import struct
+import sys
+import threading
+import time
 from warnings import warn
 
-try:
-    from pygments.lexers import guess_lexer_for_filename
-    from pygments.util import ClassNotFound
+TYPE_CHECKING = False
+if TYPE_CHECKING:  # modules only needed by optional features are imported where they are used
+    import subprocess
+    import tarfile
+    import zipfile
 
-    use_pygments = True
-except ImportError:  # pragma: no cover
-    use_pygments = False
+use_pygments = None
+"""Whether pygments is used to infer code languages (`None`: if available).
+
+pygments is only imported once it is needed, which keeps importing this module cheap.
+"""
 
 __version__ = "0.0.6"
 
 
 def define_env(env):  # pragma: no cover
-    env.macro(includex)
+    global disk_cache, profiler
+    config = env.variables.get("includex") or {}
+    file_cache.max_bytes = config.get("cache_max_bytes", DEFAULT_CACHE_MAX_BYTES)
+    env.variables["includex_cache"] = file_cache
+    if config.get("cache_dir"):
+        disk_cache = DiskCache(
+            config["cache_dir"], config.get("cache_dir_max_bytes", DEFAULT_DISK_CACHE_MAX_BYTES)
+        )
+    env.variables["includex_dependencies"] = dependencies
+    if config.get("profile"):
+        profiler = Profiler()
+    if config.get("watch") and file_cache.watcher is None:
+        file_cache.watcher = create_watcher(file_cache.invalidate, config["watch"] == "poll")
+    elif file_cache.watcher is not None:
+        # a rebuild might have been started by a change the watcher didn't handle yet
+        file_cache.watcher.poll()
+    if config.get("prerender"):
+        docs_dir = pathlib.Path(env.conf["docs_dir"])
+        workers = config["prerender"] if config["prerender"] is not True else None
+        prerendered.clear()
+        prerendered.update(prerender(sorted(docs_dir.rglob("*.md")), workers))
+    env.macro(_includex_macro, "includex")
     env.macro(show_and_tell)
 
 
+def on_pre_page_macros(env):  # pragma: no cover
+    dependencies.start_page(env.page.file.src_path)
+
+
+def on_post_page_macros(env):  # pragma: no cover
+    dependencies.page = None
+
+
+def on_post_build(env):  # pragma: no cover
+    config = env.variables.get("includex") or {}
+    if disk_cache is not None:
+        disk_cache.prune()
+    # `mkdocs serve` watches these paths once the first build is done (and fails for missing ones)
+    docs_dir = os.path.abspath(env.conf["docs_dir"])
+    watch = env.conf["watch"]
+    for filepath in sorted(dependencies.files() - set(watch)):
+        if os.path.commonpath([docs_dir, filepath]) != docs_dir and os.path.exists(filepath):
+            watch.append(filepath)
+    prerendered.clear()  # included files might change before the next build
+    if profiler is not None:
+        path = config["profile"] if isinstance(config["profile"], str) else DEFAULT_PROFILE_PATH
+        profiler.write(path)
+        profiler.log_summary()
+
+
 REPLACE_NOTICE_TEMPLATE = (
     "*In the above text, the following substrings have been replaced: %s*{.caption}"
 )
@@ -35,6 +106,1132 @@ CODE_EXTENSION_TO_LANGUAGE = {"yml": "yaml", "j2": "jinja"}
 Used when pygments is not available.
 """
 
+LANGUAGE_SAMPLE_SIZE = 4096
+"""Number of characters passed to pygments when the language cannot be inferred by filename."""
+
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+"""Default size budget of the file cache (can be changed via `extra.includex.cache_max_bytes`)."""
+
+
+def _utf8(text: str) -> bytes:
+    return text.encode("utf-8", "surrogatepass")
+
+
+class _CachedFile:
+    """Content of a single file, as held by [FileCache][includex.FileCache].
+
+    Entries are shared by threads. Derived data (offsets, matches, digest, symbols) is computed
+    lazily without locking, so concurrent threads might compute it more than once, but always
+    see complete results.
+    """
+
+    __slots__ = (
+        "fingerprint",
+        "size",
+        "text",
+        "lines",
+        "_offsets",
+        "_matches",
+        "_digest",
+        "_symbols",
+    )
+
+    def __init__(self, text: str, fingerprint: tuple[int, int], size: int):
+        self.fingerprint = fingerprint
+        self.size = size
+        self.text = text
+        self.lines = _split_lines(text)
+        self._offsets = None
+        self._matches = {}
+        self._digest = None
+        self._symbols = None
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 hash of *text*."""
+        if self._digest is None:
+            self._digest = hashlib.sha256(_utf8(self.text)).hexdigest()
+        return self._digest
+
+    @property
+    def offsets(self) -> list[int]:
+        """Offset of each line into *text* (followed by the length of *text*)."""
+        if self._offsets is None:
+            self._offsets = [0, *itertools.accumulate(map(len, self.lines))]
+        return self._offsets
+
+    @property
+    def symbols(self) -> dict[str, tuple[int, int, int]]:
+        """Classes and functions defined in *text*, if it is Python source code.
+
+        Returns:
+            map of qualified names (e.g. `Class.method`) to first line (including decorators),
+            line of definition and last line (one-based)
+        """
+        if self._symbols is None:
+            self._symbols = _index_symbols(ast.parse(self.text))
+        return self._symbols
+
+    def find(self, needle: str | re.Pattern) -> tuple[int, ...]:
+        """Return indices of all lines that contain *needle* (or where a match of it starts).
+
+        The whole text is searched at once and the result is cached, so subsequent searches
+        for the same *needle* are free.
+        """
+        try:
+            return self._matches[needle]
+        except KeyError:
+            pass
+        if isinstance(needle, str):
+            found = self._find_text(needle)
+        else:
+            found = self._find_pattern(needle)
+        self._matches[needle] = found = tuple(found)
+        return found
+
+    def _find_text(self, needle: str) -> list[int]:
+        text, offsets, found = self.text, self.offsets, []
+        pos = text.find(needle)
+        while pos != -1:
+            i = bisect.bisect_right(offsets, pos) - 1
+            if pos + len(needle) <= offsets[i + 1]:
+                found.append(i)
+                pos = text.find(needle, offsets[i + 1])
+            else:  # match spans multiple lines
+                pos = text.find(needle, pos + 1)
+        return found
+
+    def _find_pattern(self, pattern: re.Pattern) -> list[int]:
+        offsets, found = self.offsets, []
+        next_line = 0  # offset of the line following the last matched line
+        for match in pattern.finditer(self.text):
+            pos = match.start()
+            if pos < next_line:
+                continue
+            i = bisect.bisect_right(offsets, pos) - 1
+            if i >= len(self.lines):  # empty match at the very end of the text
+                break
+            found.append(i)
+            next_line = offsets[i + 1]
+        return found
+
+
+def _index_symbols(node: ast.AST, prefix: str = "") -> dict[str, tuple[int, int, int]]:
+    """Return lines of all classes and functions defined in *node*, see `_CachedFile.symbols`."""
+    symbols = {}
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            name = prefix + child.name
+            first = min([child.lineno, *(d.lineno for d in child.decorator_list)])
+            last = getattr(child, "end_lineno", None)  # not available before Python 3.8
+            if last is None:  # pragma: no cover
+                last = max(getattr(n, "lineno", 0) for n in ast.walk(child))
+            symbols[name] = (first, child.lineno, last)
+            symbols.update(_index_symbols(child, name + "."))
+        elif not isinstance(child, (ast.expr, ast.Lambda)):
+            # definitions in compound statements (e.g. `if TYPE_CHECKING:`) belong to same scope
+            symbols.update(_index_symbols(child, prefix))
+    return symbols
+
+
+BINARY_SNIFF_BYTES = 8192
+"""Number of bytes at the beginning of a file that are checked for NUL bytes."""
+
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),  # must be checked before UTF-16 LE, which is a prefix
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+
+def _detect_encoding(head: bytes, encoding: str | None, filepath) -> str:
+    """Return encoding of a file starting with *head*.
+
+    Args:
+        head: first bytes of file
+        encoding: explicit encoding, which takes precedence over a byte order mark
+        filepath: file to report in error messages
+
+    Raises:
+        BinaryFileError: if *head* contains NUL bytes, but the encoding is not UTF-16 or UTF-32
+    """
+    if encoding is None:
+        for bom, bom_encoding in _BOMS:
+            if head.startswith(bom):
+                return bom_encoding
+        encoding = locale.getpreferredencoding(False)
+    if not _is_wide_encoding(encoding) and b"\0" in head[:BINARY_SNIFF_BYTES]:
+        raise BinaryFileError(f"{filepath} seems to be a binary file")
+    return encoding
+
+
+def _is_wide_encoding(encoding: str) -> bool:
+    """Whether line breaks are not encoded as single `\\n` bytes in *encoding*."""
+    return codecs.lookup(encoding).name.startswith(("utf-16", "utf-32"))
+
+
+def _decode(data: bytes, encoding: str | None, filepath) -> str:
+    """Decode *data* like reading a file in text mode would.
+
+    If no *encoding* is given, it is detected by byte order mark, falling back to the locale's
+    preferred encoding. Line breaks are normalized to `\\n`.
+    """
+    text = data.decode(_detect_encoding(data[:BINARY_SNIFF_BYTES], encoding, filepath))
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def _split_lines(text: str) -> tuple[str, ...]:
+    """Split *text* like `readlines` does (`str.splitlines` also splits on other characters)."""
+    lines = [line + "\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return tuple(lines)
+
+
+FILE_LOCK_STRIPES = 64
+"""Number of locks files are distributed over while they are read into the cache."""
+
+
+class FileCache:
+    """Process-wide cache of included files.
+
+    Each file is read and split into lines only once. Before an entry is reused, its
+    `(st_mtime_ns, st_size)` fingerprint is compared to the file on disk, so modified files
+    are read again. When the size of all cached files exceeds *max_bytes*, the least recently
+    used entries are evicted.
+
+    Archive members and compressed files (see [Archives][includex.Archives]) are cached by
+    their decompressed content and fingerprinted by the archive or compressed file on disk.
+
+    If a *watcher* (see [create_watcher][includex.create_watcher]) is set, files are watched
+    once read and their entries are invalidated as soon as they change, so entries of watched
+    files are reused without checking their fingerprint.
+
+    The cache is thread-safe. Files are read while holding one of `FILE_LOCK_STRIPES` locks
+    (selected by path), so a file is only read once by concurrent threads, while different
+    files are read concurrently.
+
+    Args:
+        max_bytes: size budget for all cached files (measured by their decompressed size)
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.watcher: InotifyWatcher | PollingWatcher | None = None
+        self._entries: collections.OrderedDict[tuple[str, str | None], _CachedFile] = (
+            collections.OrderedDict()
+        )
+        self._size = 0
+        self._invalidations = 0
+        self._lock = threading.Lock()
+        self._file_locks = tuple(threading.Lock() for _ in range(FILE_LOCK_STRIPES))
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        """Size of all cached files in bytes."""
+        return self._size
+
+    def get(self, filepath: str | pathlib.Path, encoding: str | None = None) -> _CachedFile:
+        """Return content of *filepath*, reading it only if not cached or modified.
+
+        See [_decode][includex._decode] for how *encoding* is used.
+        """
+        path = os.path.abspath(filepath)
+        key = (path, encoding)
+        invalidations = self._invalidations
+        entry, fingerprint = self._fresh(path, key)
+        if entry is not None:
+            return entry
+
+        with self._file_locks[hash(path) % FILE_LOCK_STRIPES]:
+            entry = self._lookup(key, fingerprint)  # another thread might have read it meanwhile
+            if entry is not None:
+                return entry
+            with self._lock:
+                self.misses += 1
+            with archives.open(path) as f:
+                # check for binary content before reading the whole file
+                data = f.read(BINARY_SNIFF_BYTES)
+                _detect_encoding(data, encoding, path)
+                if len(data) == BINARY_SNIFF_BYTES:
+                    data += f.read()
+            entry = _CachedFile(_decode(data, encoding, path), fingerprint, len(data))
+            self._store(key, entry, invalidations)
+        return entry
+
+    def lookup(
+        self, filepath: str | pathlib.Path, encoding: str | None = None
+    ) -> tuple[_CachedFile | None, tuple[int, int] | None]:
+        """Return content of *filepath*, if it is cached and not modified, without reading it.
+
+        Returns:
+            the cached entry (or `None`) and the fingerprint of the file on disk, which is
+            `None` if the entry of a watched file is returned without checking the file
+        """
+        path = os.path.abspath(filepath)
+        return self._fresh(path, (path, encoding))
+
+    def _fresh(
+        self, path: str, key: tuple[str, str | None]
+    ) -> tuple[_CachedFile | None, tuple[int, int] | None]:
+        disk_path = _split_archive_path(path)[0]
+        watcher = self.watcher
+        if watcher is not None:
+            if disk_path in watcher:
+                entry = self._lookup(key)
+                if entry is not None:
+                    return entry, None
+            else:
+                watcher.watch(disk_path)  # before reading, so no change can be missed
+        stat = os.stat(disk_path)
+        fingerprint = (stat.st_mtime_ns, stat.st_size)
+        return self._lookup(key, fingerprint), fingerprint
+
+    def _lookup(
+        self, key: tuple[str, str | None], fingerprint: tuple[int, int] | None = None
+    ) -> _CachedFile | None:
+        """Return entry of *key*, if it matches *fingerprint* (if given)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and fingerprint in (None, entry.fingerprint):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        return None
+
+    def _store(
+        self, key: tuple[str, str | None], entry: _CachedFile, invalidations: int | None = None
+    ):
+        with self._lock:
+            self._discard(key)
+            # the file might have changed while it was read, if it has been invalidated since
+            if entry.size <= self.max_bytes and invalidations in (None, self._invalidations):
+                self._entries[key] = entry
+                self._size += entry.size
+                self._evict()
+
+    def invalidate(self, path: str):
+        """Remove entries of *path* (including members, if it is an archive)."""
+        member_prefix = path + ARCHIVE_SEPARATOR
+        with self._lock:
+            self._invalidations += 1
+            for key in [k for k in self._entries if k[0] == path or k[0].startswith(member_prefix)]:
+                self._discard(key)
+
+    def clear(self):
+        """Remove all entries and reset hit/miss counters."""
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.misses = 0
+
+    def _discard(self, key: tuple[str, str | None]):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+
+
+file_cache = FileCache()
+"""Cache shared by all calls to [includex][includex.includex]."""
+
+
+def create_watcher(callback, polling: bool = False) -> InotifyWatcher | PollingWatcher:
+    """Return watcher calling *callback* with the path of each watched file that changes.
+
+    Uses [InotifyWatcher][includex.InotifyWatcher] where available (Linux), falling back to
+    [PollingWatcher][includex.PollingWatcher] (or if *polling* is set).
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(callback)
+        except (OSError, AttributeError):  # no inotify on this platform
+            pass
+    return PollingWatcher(callback)
+
+
+class InotifyWatcher:
+    """Watch files for changes using inotify (Linux only).
+
+    Parent directories are watched instead of files themselves, so files that are replaced
+    (e.g. by editors saving to a temporary file first) or deleted are noticed as well. For
+    symbolic links, the directories of both the link and its target are watched.
+
+    Args:
+        callback: called (from a background thread) with the path of each changed file
+
+    Raises:
+        OSError: if inotify is not available
+    """
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+    _IN_IGNORED = 0x8000
+    _IN_Q_OVERFLOW = 0x4000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, callback):
+        import ctypes
+        import ctypes.util
+
+        self._callback = callback
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories: dict[int, str] = {}
+        self._descriptors: dict[str, int] = {}
+        self._files: set[str] = set()
+        self._targets: dict[str, set[str]] = {}  # watched paths (and link targets) to files
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._stop_read, self._stop_write = os.pipe()
+        self._thread = threading.Thread(target=self._run, name="includex-inotify", daemon=True)
+        self._thread.start()
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._files
+
+    def watch(self, path: str):
+        """Start watching *path* (an absolute path)."""
+        targets = {path, os.path.realpath(path)}
+        with self._lock:
+            for target in targets:
+                directory = os.path.dirname(target)
+                if directory not in self._descriptors:
+                    wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+                    if wd < 0:
+                        return  # e.g. no permission, so the file is checked on each use
+                    self._descriptors[directory] = wd
+                    self._directories[wd] = directory
+            for target in targets:
+                self._targets.setdefault(target, set()).add(path)
+            self._files.add(path)
+
+    def stop(self):
+        """Stop watching all files."""
+        os.write(self._stop_write, b"\0")
+        self._thread.join()
+        for fd in (self._fd, self._stop_read, self._stop_write):
+            os.close(fd)
+
+    def poll(self):
+        """Process pending events now, instead of waiting for the background thread.
+
+        Changes made before this call are always noticed, as the kernel queues events
+        immediately.
+        """
+        with self._read_lock:
+            while select.select([self._fd], [], [], 0)[0]:
+                self._process(os.read(self._fd, 64 * 1024))
+
+    def _run(self):
+        while True:
+            ready, _, _ = select.select([self._fd, self._stop_read], [], [])
+            if self._stop_read in ready:
+                return
+            self.poll()
+
+    def _process(self, data: bytes):
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, pos)
+            name = data[pos + self._EVENT.size : pos + self._EVENT.size + length]
+            pos += self._EVENT.size + length
+            if mask & self._IN_Q_OVERFLOW:  # events were lost
+                for path in list(self._files):
+                    self._callback(path)
+            elif mask & self._IN_IGNORED:  # directory was removed
+                self._forget(wd)
+            elif wd in self._directories:
+                target = os.path.join(self._directories[wd], os.fsdecode(name.rstrip(b"\0")))
+                with self._lock:
+                    paths = tuple(self._targets.get(target, ()))
+                for path in paths:
+                    self._callback(path)
+
+    def _forget(self, wd: int):
+        with self._lock:
+            directory = self._directories.pop(wd, None)
+            if directory is None:
+                return
+            del self._descriptors[directory]
+            targets = [t for t in self._targets if os.path.dirname(t) == directory]
+            files = set().union(*(self._targets.pop(target) for target in targets))
+            self._files -= files  # watched again on next use
+        for path in files:
+            self._callback(path)
+
+
+class PollingWatcher:
+    """Watch files for changes by checking their fingerprint periodically.
+
+    Used where inotify is not available. Files are checked by a background thread, so
+    includes don't need to wait for it.
+
+    Args:
+        callback: called (from a background thread) with the path of each changed file
+        interval: seconds between checks
+    """
+
+    def __init__(self, callback, interval: float = 1.0):
+        self._callback = callback
+        self.interval = interval
+        self._fingerprints: dict[str, tuple[int, int] | None] = {}
+        self._poll_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="includex-polling", daemon=True)
+        self._thread.start()
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._fingerprints
+
+    def watch(self, path: str):
+        """Start watching *path* (an absolute path)."""
+        self._fingerprints[path] = self._fingerprint(path)
+
+    def stop(self):
+        """Stop watching all files."""
+        self._stopped.set()
+        self._thread.join()
+
+    def poll(self):
+        """Check all watched files for changes now."""
+        with self._poll_lock:
+            for path, fingerprint in list(self._fingerprints.items()):
+                current = self._fingerprint(path)
+                if current != fingerprint:
+                    self._fingerprints[path] = current
+                    self._callback(path)
+
+    @staticmethod
+    def _fingerprint(path: str) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.poll()
+
+
+ARCHIVE_SEPARATOR = "!/"
+"""Separates the path of an archive from the name of a member (e.g. `examples.zip!/app/main.py`)."""
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".xz": "lzma", ".bz2": "bz2"}
+"""Files with these suffixes are decompressed by the named module when included (e.g.
+`build.log.gz`)."""
+
+
+def _split_archive_path(filepath: str | pathlib.Path) -> tuple[str, str | None]:
+    """Split *filepath* into the path of a file on disk and the name of an archive member."""
+    path = str(filepath)
+    pos = path.find(ARCHIVE_SEPARATOR)
+    while pos != -1:
+        if os.path.isfile(path[:pos]):
+            return path[:pos], path[pos + len(ARCHIVE_SEPARATOR) :]
+        pos = path.find(ARCHIVE_SEPARATOR, pos + 1)
+    return path, None
+
+
+class Archives:
+    """Open files for reading, transparently handling archive members and compressed files.
+
+    Zip and tar archives are kept open across includes, so their index of members (the central
+    directory of zip files) is only read once. Archives are opened again when modified.
+    """
+
+    def __init__(self):
+        self._archives: dict[str, tuple[tuple[int, int], zipfile.ZipFile | tarfile.TarFile]] = {}
+        self._lock = threading.Lock()
+
+    def open(self, filepath: str | pathlib.Path) -> io.BufferedIOBase:
+        """Return binary stream of the (decompressed) content of *filepath*."""
+        path, member = _split_archive_path(filepath)
+        if member is None:
+            compression = COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1])
+            if compression is None:
+                return open(path, "rb")
+            return importlib.import_module(compression).open(path, "rb")
+        import zipfile
+
+        with self._lock:
+            archive = self._archive(path)
+            try:
+                if isinstance(archive, zipfile.ZipFile):
+                    return archive.open(member)  # members of zip files can be read concurrently
+                stream = archive.extractfile(member)
+                if stream is None:
+                    raise IsADirectoryError(f"{member} in {path} is not a file")
+                # members of tar files share the file position of the archive
+                with stream:
+                    return io.BytesIO(stream.read())
+            except KeyError:
+                raise FileNotFoundError(f"{member} does not exist in {path}") from None
+
+    def close(self):
+        """Close all open archives."""
+        with self._lock:
+            for _, archive in self._archives.values():
+                archive.close()
+            self._archives.clear()
+
+    def _archive(self, path: str) -> zipfile.ZipFile | tarfile.TarFile:
+        import tarfile
+        import zipfile
+
+        stat = os.stat(path)
+        fingerprint = (stat.st_mtime_ns, stat.st_size)
+        cached = self._archives.get(path)
+        if cached is not None:
+            if cached[0] == fingerprint:
+                return cached[1]
+            cached[1].close()
+        archive = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else tarfile.open(path)
+        self._archives[path] = (fingerprint, archive)
+        return archive
+
+
+archives = Archives()
+"""Archives opened by [includex][includex.includex]."""
+
+atexit.register(archives.close)
+
+
+class DependencyGraph:
+    """Record which files are included by which page.
+
+    mkdocs only knows about files in the docs directory, so changes to files included by
+    [includex][includex.includex] from elsewhere would go unnoticed by `mkdocs serve`. All
+    files recorded here that exist are added to mkdocs' `watch` list at the end of the build.
+    """
+
+    def __init__(self):
+        self._files: dict[str, set[str]] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def page(self) -> str | None:
+        """Page that is currently rendered (by the current thread)."""
+        return getattr(self._local, "page", None)
+
+    @page.setter
+    def page(self, page: str | None):
+        self._local.page = page
+
+    def start_page(self, page: str):
+        """Start recording dependencies of *page*, forgetting previously recorded ones."""
+        self.page = page
+        with self._lock:
+            self._files[page] = set()
+
+    def add(self, filepath: str | pathlib.Path):
+        """Record that the current page includes *filepath*."""
+        page = self.page
+        if page is not None:
+            with self._lock:
+                self._files[page].add(os.path.abspath(filepath))
+
+    def files(self, page: str | None = None) -> set[str]:
+        """Return files included by *page* (or by any page)."""
+        with self._lock:
+            if page is not None:
+                return set(self._files.get(page, ()))
+            return set().union(*self._files.values())
+
+    def pages(self, filepath: str | pathlib.Path) -> set[str]:
+        """Return pages that include *filepath*."""
+        filepath = os.path.abspath(filepath)
+        with self._lock:
+            return {page for page, files in self._files.items() if filepath in files}
+
+
+dependencies = DependencyGraph()
+"""Files included by each page, as recorded by [includex][includex.includex]."""
+
+
+class GitRepository:
+    """Read files of a git repository at any revision.
+
+    Revisions are resolved by a long-running `git cat-file --batch-check` process and blobs are
+    read by a long-running `git cat-file --batch` process, so no process needs to be started per
+    file. Blobs are immutable, so their content is cached by object id (sharing the budget of
+    [file_cache][includex.file_cache]) and never needs to be checked for changes.
+
+    Use [for_path][includex.GitRepository.for_path] to get the repository of a file.
+
+    Args:
+        root: top-level directory of the repository
+    """
+
+    _repositories: dict[str, GitRepository] = {}
+
+    def __init__(self, root: str):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self._processes: dict[str, subprocess.Popen] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, filepath: str | pathlib.Path) -> GitRepository:
+        """Return repository containing *filepath* (which need not exist in the working tree)."""
+        root = _git_root(os.path.dirname(os.path.realpath(filepath)))
+        try:
+            return cls._repositories[root]
+        except KeyError:
+            return cls._repositories.setdefault(root, cls(root))
+
+    @classmethod
+    def close_all(cls):
+        """Stop processes of all repositories."""
+        for repository in cls._repositories.values():
+            repository.close()
+
+    def get(self, filepath: str | pathlib.Path, rev: str, encoding: str | None = None):
+        """Return content of *filepath* at revision *rev*.
+
+        See [FileCache.get][includex.FileCache.get] for how *encoding* is used.
+        """
+        path = pathlib.Path(os.path.relpath(os.path.realpath(filepath), self.root)).as_posix()
+        obj = f"{rev}:{path}"
+        if "\n" in obj:  # would be read as several requests by git cat-file
+            raise ValueError(f"revision and path must not contain line breaks: {obj!r}")
+        with self._lock:
+            oid, kind, size = self._request("--batch-check", obj)
+            if kind != "blob":
+                raise IsADirectoryError(f"{obj} is a {kind}, not a file")
+            key = (f"git:{oid}", encoding)  # never conflicts with the absolute paths of files
+            entry = file_cache._lookup(key, (oid, size))
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            self._request("--batch", oid)
+            data = self._processes["--batch"].stdout.read(size + 1)
+            if len(data) != size + 1 or data[-1:] != b"\n":
+                self._kill("--batch")
+                raise OSError(f"git cat-file returned incomplete content of {obj}")
+            data = data[:-1]
+        entry = _CachedFile(_decode(data, encoding, obj), (oid, size), size)
+        file_cache._store(key, entry)
+        return entry
+
+    def close(self):
+        """Stop running processes (they are started again when needed)."""
+        with self._lock:
+            for process in self._processes.values():
+                process.stdin.close()
+                process.wait()
+            self._processes.clear()
+
+    def _request(self, mode: str, obj: str) -> tuple[str, str, int]:
+        """Request *obj* from the `git cat-file` process in *mode* and return its header.
+
+        If the reply doesn't match the request, the process is killed, so the next request
+        starts a new process instead of reading replies to previous requests.
+        """
+        import subprocess
+
+        process = self._processes.get(mode)
+        if process is None or process.poll() is not None:
+            process = self._processes[mode] = subprocess.Popen(
+                ["git", "cat-file", mode],
+                cwd=self.root,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        try:
+            process.stdin.write(f"{obj}\n".encode())
+            process.stdin.flush()
+            header = process.stdout.readline().decode()
+        except OSError:
+            self._kill(mode)
+            raise
+        if header in (f"{obj} missing\n", f"{obj} ambiguous\n"):
+            raise FileNotFoundError(f"{obj} does not exist in git repository")
+        fields = header.split()
+        if (
+            not header.endswith("\n")
+            or len(fields) != 3
+            or not fields[2].isdigit()
+            or (mode == "--batch" and fields[0] != obj)
+        ):
+            self._kill(mode)
+            raise OSError(f"unexpected reply of git cat-file to {obj!r}: {header!r}")
+        return fields[0], fields[1], int(fields[2])
+
+    def _kill(self, mode: str):
+        process = self._processes.pop(mode, None)
+        if process is not None:
+            process.kill()
+            process.wait()
+
+
+@functools.lru_cache(maxsize=None)
+def _git_root(directory: str) -> str:
+    """Return top-level directory of the git repository containing *directory*."""
+    import subprocess
+
+    while not os.path.isdir(directory):  # directory might only exist in other revisions
+        directory = os.path.dirname(directory)
+    try:
+        process = subprocess.run(
+            ["git", "rev-parse", "--show-toplevel"],
+            cwd=directory,
+            capture_output=True,
+            check=True,
+        )
+    except subprocess.CalledProcessError:
+        raise ValueError(f"{directory} is not in a git repository") from None
+    return os.path.realpath(process.stdout.decode().strip())
+
+
+atexit.register(GitRepository.close_all)
+
+
+DEFAULT_PROFILE_PATH = "includex-profile.json"
+"""Default path of the profile report (see `extra.includex.profile`)."""
+
+PROFILE_PHASES = ("read", "match", "transform", "language", "render")
+
+
+class Profiler:
+    """Collect performance data of each call to [includex][includex.includex].
+
+    For each call, the included file, arguments, bytes read, lines scanned, cache outcome and
+    time spent in each phase (read, match, transform, language inference, render) is recorded.
+    """
+
+    def __init__(self):
+        self.records: list[dict] = []
+
+    def start(self, filepath, options: dict) -> _ProfileRecord:
+        """Start recording a call."""
+        return _ProfileRecord(self, filepath, options)
+
+    def slowest(self, n: int = 20) -> list[dict]:
+        """Return records of the *n* slowest calls."""
+        return sorted(self.records, key=lambda record: record["time"], reverse=True)[:n]
+
+    def report(self) -> dict:
+        """Return all records and their totals."""
+        return {
+            "calls": len(self.records),
+            "time": sum(record["time"] for record in self.records),
+            "phases": {
+                phase: sum(record["phases"][phase] for record in self.records)
+                for phase in PROFILE_PHASES
+            },
+            "records": self.records,
+        }
+
+    def write(self, path: str | pathlib.Path):
+        """Write [report][includex.Profiler.report] to *path* as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, default=str)
+
+    def log_summary(self, n: int = 20):
+        """Log the *n* slowest calls."""
+        import logging
+
+        log = logging.getLogger("mkdocs.plugins.includex")
+        report = self.report()
+        log.info(
+            "includex: %d calls took %.3fs (%s)",
+            report["calls"],
+            report["time"],
+            ", ".join(f"{phase}: {t:.3f}s" for phase, t in report["phases"].items()),
+        )
+        for record in self.slowest(n):
+            log.info(
+                "includex: %8.2fms %s (%s, %d bytes read, %d lines scanned)",
+                1000 * record["time"],
+                record["filepath"],
+                record["cache"],
+                record["bytes_read"],
+                record["lines_scanned"],
+            )
+
+
+class _ProfileRecord:
+    """Performance data of a single call, see [Profiler][includex.Profiler]."""
+
+    __slots__ = ("profiler", "data", "start", "last")
+
+    def __init__(self, profiler: Profiler, filepath, options: dict):
+        self.profiler = profiler
+        self.data = {
+            "filepath": str(filepath),
+            "arguments": {k: v for k, v in options.items() if k != "filepath"},
+            "cache": None,
+            "bytes_read": 0,
+            "lines_scanned": 0,
+            "phases": dict.fromkeys(PROFILE_PHASES, 0.0),
+        }
+        self.start = self.last = time.perf_counter()
+
+    def phase(self, name: str):
+        """Attribute the time since the previous phase ended to phase *name*."""
+        now = time.perf_counter()
+        self.data["phases"][name] += now - self.last
+        self.last = now
+
+    def update(self, **data):
+        self.data.update(data)
+
+    def finish(self):
+        self.data["time"] = time.perf_counter() - self.start
+        self.profiler.records.append(self.data)
+
+
+class _NoProfileRecord:
+    """Stands in for [_ProfileRecord][includex._ProfileRecord] if profiling is disabled."""
+
+    __slots__ = ()
+
+    def phase(self, name: str):
+        pass
+
+    def update(self, **data):
+        pass
+
+    def finish(self):
+        pass
+
+
+_NO_PROFILE_RECORD = _NoProfileRecord()
+
+profiler = None
+"""[Profiler][includex.Profiler] used by [includex][includex.includex], if enabled via
+`extra.includex.profile`."""
+
+
+DEFAULT_DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+"""Default size budget of the persistent cache (see `extra.includex.cache_dir_max_bytes`)."""
+
+
+class DiskCache:
+    """Persistent cache of rendered includes, which can be shared between builds.
+
+    Each entry is stored in its own file, named by the hash of its key. Files are written to a
+    temporary file first and then moved into place, so multiple builds can safely share the same
+    *directory*. Reading an entry updates its modification time, which is used by
+    [prune][includex.DiskCache.prune] to remove the least recently used entries.
+
+    Args:
+        directory: directory to store entries in (created if it doesn't exist)
+        max_bytes: size budget for all entries, enforced by [prune][includex.DiskCache.prune]
+    """
+
+    def __init__(
+        self, directory: str | pathlib.Path, max_bytes: int = DEFAULT_DISK_CACHE_MAX_BYTES
+    ):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Return key for any number of JSON serializable *parts*."""
+        data = json.dumps([__version__, *parts], sort_keys=True, default=str)
+        return hashlib.sha256(_utf8(data)).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """Return entry for *key* or `None`, if there is no such entry."""
+        path = self._path(key)
+        try:
+            value = path.read_text(encoding="utf-8")
+            os.utime(path)
+        except FileNotFoundError:  # may also be pruned concurrently after reading it
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: str):
+        """Store *value* as entry for *key*."""
+        import tempfile
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def prune(self):
+        """Remove least recently used entries until the cache fits into *max_bytes*."""
+        entries, size = [], 0
+        for path in self.directory.glob("*/*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.name.startswith(".tmp-"):
+                # leftover of an interrupted build (or still being written by a concurrent one)
+                if stat.st_mtime < time.time() - 3600:
+                    self._unlink(path)
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+            size += stat.st_size
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            self._unlink(path)
+            size -= entry_size
+
+    @staticmethod
+    def _unlink(path: pathlib.Path):
+        try:
+            path.unlink()
+        except FileNotFoundError:  # already removed by concurrent build
+            pass
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / key[:2] / key
+
+
+disk_cache = None
+"""Persistent cache ([DiskCache][includex.DiskCache]) used by [includex][includex.includex], if
+enabled via `extra.includex.cache_dir`."""
+
+
+STREAMING_MIN_BYTES = 1024 * 1024
+"""Files of at least this size are not read in full (or cached) if only their head or tail is
+included."""
+
+STREAMING_BLOCK_SIZE = 64 * 1024
+"""Size of blocks read when counting lines of a file (for captions of streamed tails)."""
+
+
+def _read_range(
+    filepath: pathlib.Path, start_idx: int, end_idx: int | None, encoding: str | None = None
+) -> list[str] | None:
+    """Read lines *start_idx* to *end_idx* of a large file without decoding all of it.
+
+    The file is memory-mapped and line breaks are searched for in its raw bytes, so only the
+    lines in range are decoded.
+
+    Returns:
+        the lines in range or `None`, if the file is too small or the range cannot be streamed
+    """
+    head = start_idx >= 0 and end_idx is not None and end_idx >= 0
+    tail = start_idx < 0 and (end_idx is None or end_idx < 0)
+    path, member = _split_archive_path(filepath)
+    if member is not None or os.path.splitext(path)[1] in COMPRESSION_SUFFIXES:
+        if not head or os.stat(path).st_size < STREAMING_MIN_BYTES:
+            return None
+        return _read_compressed_range(filepath, start_idx, end_idx, encoding)
+    if not (head or tail):
+        return None
+    with open(filepath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < STREAMING_MIN_BYTES:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            sniffed = mm[:BINARY_SNIFF_BYTES]
+            encoding = _detect_encoding(sniffed, encoding, filepath)
+            if _is_wide_encoding(encoding) or (b"\r" in sniffed and b"\n" not in sniffed):
+                return None  # line breaks are searched for as `\n` only
+            if head:
+                start = _skip_lines(mm, start_idx, 0)
+                end = _skip_lines(mm, end_idx - start_idx, start)
+                if _has_bare_cr(mm, 0, end):
+                    return None
+                data = mm[start:end]
+            else:
+                # a line break at the very end of the file doesn't start another line
+                pos = size - 1 if mm[-1:] == b"\n" else size
+                for _ in range(-start_idx):
+                    pos = mm.rfind(b"\n", 0, pos)
+                    if pos == -1:
+                        break
+                if _has_bare_cr(mm, pos + 1, size):
+                    return None
+                data = mm[pos + 1 :]
+    lines = list(_split_lines(_decode(data, encoding, filepath)))
+    return lines if head else lines[:end_idx]
+
+
+def _read_compressed_range(
+    filepath: pathlib.Path, start_idx: int, end_idx: int, encoding: str | None = None
+) -> list[str] | None:
+    """Read lines *start_idx* to *end_idx* of an archive member or compressed file.
+
+    Content is decompressed only up to line *end_idx*.
+    """
+    with archives.open(filepath) as f:
+        # check for binary content first, as binary files might not contain any line breaks
+        head = f.read(BINARY_SNIFF_BYTES)
+        encoding = _detect_encoding(head, encoding, filepath)
+        if _is_wide_encoding(encoding) or (b"\r" in head and b"\n" not in head):
+            return None
+        *lines, rest = head.split(b"\n")
+        lines = [line + b"\n" for line in lines[:end_idx]]
+        if len(lines) < end_idx:
+            lines.append(rest + f.readline())
+            lines.extend(itertools.islice(f, end_idx - len(lines)))
+    lines = [line for line in lines if line]  # the file might have ended with the head
+    if any(_has_bare_cr(line, 0, len(line)) for line in lines):
+        return None
+    return list(_split_lines(_decode(b"".join(lines[start_idx:]), encoding, filepath)))
+
+
+def _skip_lines(mm: mmap.mmap, n: int, pos: int) -> int:
+    """Return offset of the line *n* lines after the line starting at *pos*."""
+    for _ in range(n):
+        pos = mm.find(b"\n", pos)
+        if pos == -1:
+            return len(mm)
+        pos += 1
+    return pos
+
+
+def _has_bare_cr(data: bytes | mmap.mmap, start: int, end: int) -> bool:
+    """Whether *data* contains a `\r` line break (not followed by `\n`) in *start* to *end*."""
+    pos = data.find(b"\r", start, end)
+    while pos != -1:
+        if data[pos + 1 : pos + 2] != b"\n":
+            return True
+        pos = data.find(b"\r", pos + 2, end)
+    return False
+
+
+def _count_lines(filepath: pathlib.Path) -> int:
+    """Count lines of *filepath* without decoding it (like [_decode][includex._decode] would)."""
+    count, last = 0, b"\n"
+    with archives.open(filepath) as f:
+        for block in iter(functools.partial(f.read, STREAMING_BLOCK_SIZE), b""):
+            count += block.count(b"\n") + block.count(b"\r") - block.count(b"\r\n")
+            if last == b"\r" and block[:1] == b"\n":
+                count -= 1  # `\r\n` split between blocks
+            last = block[-1:]
+    return count + (last not in (b"\n", b"\r"))
+
 
 def includex(
     filepath: pathlib.Path,
@@ -51,6 +1248,14 @@ def includex(
     start_offset: int = 0,
     end_offset: int = 0,
     include_end_match: bool = False,
+    start_match_occurrence: int = 1,
+    end_match_occurrence: int = 1,
+    start_regex: str = "",
+    end_regex: str = "",
+    match_mode: str = "contains",
+    symbol: str = "",
+    encoding: str = None,
+    rev: str = None,
     silence_errors: bool = False,
     raise_errors: bool = True,
     raw: bool = False,
@@ -64,6 +1269,10 @@ def includex(
     alt_code_fences: bool | str = False,
     suffix: str = "",
     code: bool | str = False,
+    highlight: bool = False,
+    linenos: bool = False,
+    ranges: list[tuple[int | str | None, int | str | None]] = None,
+    elision: str = "",
 ) -> str:
     r"""Include parts of a file.
 
@@ -73,6 +1282,15 @@ def includex(
 
     Args:
         filepath: file to include
+
+            Members of zip and tar archives are included by separating the path of the archive
+            and the name of the member by `!/` (e.g. `examples.zip!/app/main.py`). Files ending
+            in `.gz`, `.xz` or `.bz2` are decompressed.
+
+            Glob patterns (e.g. `examples/**/*.yml`) include all matching files, sorted by path
+            and separated by an empty line, each rendered with the same options (e.g. with its
+            own code block and caption). Files are read concurrently.
+
         start: line number to begin include (is overwritten, if start_match matches a line).
         end: line number to end include on (is overwritten, if end_match matches a line).
 
@@ -106,6 +1324,47 @@ def includex(
             - provide negative integer to exclude lines before matched line
 
         include_end_match: also include the ending matched line (same as `end_offset=1`)
+        start_match_occurrence: which line matched by *start_match* to use
+
+            `1` is the first matching line, `2` the second, `-1` the last, and so on.
+
+        end_match_occurrence: which line matched by *end_match* to use
+
+            Only lines after the line matched by *start_match* are considered.
+
+        start_regex: find start by providing a regular expression that shall match the first line
+
+            The expression is searched with `re.MULTILINE`, so `^` and `$` match at the
+            beginning and end of each line. Can be used instead of *start_match*, all options
+            referring to *start_match* apply to *start_regex* as well.
+
+        end_regex: find end by providing a regular expression that shall match the last line
+
+            Can be used instead of *end_match*, all options referring to *end_match* apply to
+            *end_regex* as well.
+
+        match_mode: how *start_match* and *end_match* are matched against lines
+
+            - `"contains"`: line contains the text
+            - `"startswith"`: line starts with the text (ignoring indentation)
+            - `"line"`: line is the text (ignoring indentation and trailing whitespace)
+
+        symbol: include definition of a Python class or function by its qualified name
+
+            Qualified names are relative to the included file, e.g. `"Class.method"` for the
+            method of a class defined in *filepath*. Decorators are included as well.
+            Cannot be used together with *start_match*, *end_match*, *start_regex* or *end_regex*.
+
+        encoding: encoding of the included file
+
+            By default, the encoding is detected by byte order mark (BOM), falling back to the
+            locale's preferred encoding. Files that seem to be binary are rejected.
+
+        rev: include file as it was at this git revision (e.g. a tag, branch or commit)
+
+            *filepath* must be part of a git repository, but doesn't need to exist in the
+            working tree.
+
         silence_errors: if true, do not return exception messages
         raise_errors: if true, raise exceptions instead of returning error string
         raw: will wrap file content in {% raw %} block.
@@ -146,193 +1405,788 @@ def includex(
 
             Added in v0.0.4
 
+        highlight: render code block as HTML highlighted by pygments (requires pygments)
+
+            Markdown extensions don't need to highlight the code block again, which is slow for
+            large blocks. Highlighted HTML is cached by content, language and line numbers.
+            `code` must be given for this option to have any effect.
+
+        linenos: add line numbers (of the included file) to highlighted HTML
+
+            Cannot be used with *ranges* that aren't merged into a single range.
+
+        ranges: include several ranges of the file at once, as `(start, end)` pairs
+
+            Each bound is either a line number (like *start* and *end*, `None` for the start or
+            end of the file) or text to match (like *start_match* and *end_match*, respecting
+            *match_mode* and *include_end_match*). Overlapping and adjacent ranges are merged
+            and the caption lists all of them. Cannot be combined with other options that
+            select lines.
+
+            ```py
+            includex("app.py", ranges=[(1, 5), ("class App", "def main"), ("if __name__", None)])
+            ```
+
+        elision: line to insert between ranges that are not adjacent (e.g. `"..."`)
+
     Returns:
         content of file at *filepath*, modified by remaining arguments
     """
-    # transform one-based indices into file to zero-based indices into arrays
-    start_idx = start - 1 if start > 0 else start
-    # end doesn't need to be adjusted here, as it is exclusive in Python but should be
-    # inclusive (+1) and also is a one-based index (-1)
-    end_idx = end
-    # use empty list as default argument safely
-    escape = [] if escape is None else escape
-    replace = [] if replace is None else replace
-    prefix_offset, suffix_offset = 0, 0
-    has_escaped_characters, has_replaced_characters = False, False
-
+    options = locals().copy()
+    del options["filepath"]
     try:
-        filepath = pathlib.Path(filepath)
-        content = filepath.open("r").readlines()
-        original_content = content.copy()
-        if start_match or end_match:
-            first_line_found = not start_match
-            for i, line in enumerate(content):
-                if not first_line_found and start_match in line:
-                    start_idx = i + start_offset
-                    first_line_found = True
-                    if not lines and end_match:
-                        continue
-                    else:
-                        break
-                if first_line_found and end_match and end_match in line:
-                    end_idx = i + end_offset + (1 if include_end_match else 0)
-                    break
-            else:
-                raise NoMatchError(
-                    f"Couldn't find match for {'end_match' if first_line_found else 'start_match'}="
-                    f"'{end_match if first_line_found else start_match}' in {filepath}"
-                )
-        if lines:
-            end_idx = start_idx + lines
-
-        content = content[start_idx:end_idx]
+        spec = IncludeSpec(**options)
+    except Exception as e:
+        return _error_result(e, raise_errors, silence_errors)
+    return spec.render(filepath)
 
-        if not content:
-            if raise_errors and not silence_errors:
-                raise ValueError("no content to include")
-            elif silence_errors:
-                return ""
-            else:
-                return ERROR_NOTICE_TEMPLATE % "no content to include"
 
-        for esc in escape:
-            for i, line in enumerate(content):
-                if esc in line:
-                    content[i] = line.replace(esc, "\\" + esc)
-                    has_escaped_characters = True
+class IncludeSpec:
+    """Options of [includex][includex.includex], validated and normalized once.
 
-        for orig, repl in replace:
-            for idx, line in enumerate(content):
-                if orig in line:
-                    content[idx] = line.replace(orig, repl)
-                    has_replaced_characters = True
+    A spec can render any number of files and only runs the stages of the pipeline that its
+    options need, e.g. lines included without any transformation are sliced from the cached text
+    of the file without splitting it into lines.
 
-        assert isinstance(dedent, (bool, int))
-        if dedent is True and content:
-            dedent = len(content[0].rstrip()) - len(content[0].strip())
+    Args:
+        see [includex][includex.includex] (all arguments except *filepath*)
 
-        if add_heading_levels:
-            content = [add_heading_levels * "#" + c if c.startswith("#") else c for c in content]
+    Raises:
+        ValueError: if options are invalid or conflict with each other
 
-        if not keep_trailing_whitespace:
-            content[-1] = content[-1].rstrip()
+    Example:
+        ```py
+        spec = IncludeSpec(start_match="def main", end_match="return", code=True)
+        for path in paths:
+            print(spec.render(path))
+        ```
+    """
 
-        if suffix:
-            if not content[-1].endswith("\n"):
-                content[-1] += "\n"
-            content[-1] += f"{suffix}\n"
+    def __init__(
+        self,
+        start: int = 1,
+        end: int = None,
+        lines: int = 0,
+        dedent=True,
+        indent: int = 0,
+        indent_char: str = " ",
+        indent_first: bool = False,
+        keep_trailing_whitespace: bool = False,
+        start_match: str = "",
+        end_match: str = "",
+        start_offset: int = 0,
+        end_offset: int = 0,
+        include_end_match: bool = False,
+        start_match_occurrence: int = 1,
+        end_match_occurrence: int = 1,
+        start_regex: str = "",
+        end_regex: str = "",
+        match_mode: str = "contains",
+        symbol: str = "",
+        encoding: str = None,
+        rev: str = None,
+        silence_errors: bool = False,
+        raise_errors: bool = True,
+        raw: bool = False,
+        escape: list[str] = None,
+        replace: list[tuple[str]] = None,
+        add_heading_levels: int = 0,
+        lang: str = None,
+        escape_notice: bool | str = True,
+        replace_notice: bool | str = False,
+        caption: bool | str = None,
+        alt_code_fences: bool | str = False,
+        suffix: str = "",
+        code: bool | str = False,
+        highlight: bool = False,
+        linenos: bool = False,
+        ranges: list[tuple[int | str | None, int | str | None]] = None,
+        elision: str = "",
+    ):
+        options = locals().copy()
+        del options["self"]
+        self.options = options
+        """All options (as passed), used to identify renderings in caches and profiles."""
 
+        assert isinstance(dedent, (bool, int))
+        self.start_option, self.start_value, self.start_needle = _match_option(
+            "start", start_match, start_regex, match_mode
+        )
+        self.end_option, self.end_value, self.end_needle = _match_option(
+            "end", end_match, end_regex, match_mode
+        )
+        if symbol and (self.start_needle or self.end_needle):
+            raise ValueError("symbol cannot be used together with start_match or end_match")
+        if ranges and (
+            start != 1
+            or end is not None
+            or lines
+            or self.start_needle
+            or self.end_needle
+            or symbol
+            or start_offset
+            or end_offset
+            or start_match_occurrence != 1
+            or end_match_occurrence != 1
+        ):
+            raise ValueError("ranges cannot be used together with other options selecting lines")
+        self.ranges = tuple(map(_range_option, ranges or ()))
+        self.match_mode = match_mode
+        self.elision = elision
         if lang is not None:
-            warn(
+            _warn_once(
                 "`lang` option is deprecated and will be removed in a future release. "
                 "Use `code` instead.",
                 DeprecationWarning,
-                stacklevel=2,
             )
 
-        if code is True and lang is None:
-            lang = _infer_code_language(filepath, "".join(content))
-        elif isinstance(code, str):
-            lang = code
-
-        if lang is not None:
-            code_fence_marker = (
-                "```"
-                if alt_code_fences is False
-                else ("'''" if alt_code_fences is True else alt_code_fences)
-            )
-            content.insert(0, f"{code_fence_marker}{lang}\n")
-            if not content[-1].endswith("\n"):
-                content[-1] += "\n"
-            content.append(f"{code_fence_marker}")
-            prefix_offset += 1
-            suffix_offset += 1
-
-        if raw:
-            if not content[-1].endswith("\n"):
-                content[-1] += "\n"
-            content = ["{% raw %}\n", *content, "{% endraw %}"]
-            prefix_offset += 1
-            suffix_offset += 1
-
-        # only dedent actual content, not prefix and suffix inserted by this macro
-        content = "".join(
-            [
-                ((indent_char * indent) if i > 0 or indent_first else "")
-                + line[dedent if prefix_offset <= i < len(content) - suffix_offset else None :]
-                for i, line in enumerate(content)
-            ]
+        # transform one-based indices into file to zero-based indices into arrays
+        self.start_idx = start - 1 if start > 0 else start
+        # end doesn't need to be adjusted here, as it is exclusive in Python but should be
+        # inclusive (+1) and also is a one-based index (-1)
+        self.end_idx = end
+        self.lines = lines
+        self.dedent = dedent
+        self.indent = indent_char * indent
+        self.indent_first = indent_first
+        self.keep_trailing_whitespace = keep_trailing_whitespace
+        self.start_offset, self.end_offset = start_offset, end_offset
+        self.include_end_match = include_end_match
+        self.start_match_occurrence = start_match_occurrence
+        self.end_match_occurrence = end_match_occurrence
+        self.symbol = symbol
+        self.encoding = encoding
+        self.rev = rev
+        self.silence_errors, self.raise_errors = silence_errors, raise_errors
+        self.raw = raw
+        self.escape = tuple(escape or ())
+        self.replace = tuple(map(tuple, replace or ()))
+        self.substitutions = _compile_substitutions(self.escape, self.replace)
+        self.add_heading_levels = add_heading_levels
+        self.lang = code if isinstance(code, str) else lang
+        self.infer_lang = code is True and lang is None
+        self.escape_notice, self.replace_notice = escape_notice, replace_notice
+        self.caption = caption
+        self.code_fence_marker = (
+            "```"
+            if alt_code_fences is False
+            else ("'''" if alt_code_fences is True else alt_code_fences)
         )
-
-        if escape_notice and has_escaped_characters:
-            if not content.endswith("\n"):
-                content += "\n"
-            content += (ESCAPE_NOTICE_TEMPLATE if escape_notice is True else escape_notice) % (
-                ", ".join(f"` {e} `" for e in escape)
+        self.suffix = suffix
+        self.highlight, self.linenos = highlight, linenos
+
+        self.streamable = not (self.start_needle or self.end_needle or symbol or rev or ranges)
+        """Whether only the included range of a file needs to be read."""
+        self.verbatim = not (
+            self.substitutions
+            or not (isinstance(dedent, bool) or dedent == 0)
+            or self.indent
+            or add_heading_levels
+            or suffix
+            or raw
+            or self.lang is not None
+            or self.infer_lang
+            or ranges
+        )
+        """Whether included lines are returned as they are (apart from dedent and whitespace)."""
+
+    def render(self, filepath: str | pathlib.Path) -> str:
+        """Include *filepath* as specified, see [includex][includex.includex]."""
+        if _GLOB_CHARACTERS.search(str(filepath)) and not os.path.exists(filepath):
+            return self._render_glob(str(filepath))
+        record = _NO_PROFILE_RECORD if profiler is None else profiler.start(filepath, self.options)
+        start_idx, end_idx, lines = self.start_idx, self.end_idx, self.lines
+        escape, replace, dedent, lang = self.escape, self.replace, self.dedent, self.lang
+        prefix_offset, suffix_offset = 0, 0
+        has_escaped_characters, has_replaced_characters = False, False
+
+        try:
+            options = {"filepath": filepath, **self.options}
+            filepath = pathlib.Path(filepath)
+            dependencies.add(_split_archive_path(filepath)[0])
+            content = cached = None
+            hit = False
+            if self.streamable:
+                # large files are only streamed, if they are not cached already
+                cached, fingerprint = file_cache.lookup(filepath, self.encoding)
+                hit = cached is not None
+                if not hit and fingerprint[1] >= STREAMING_MIN_BYTES:
+                    end_idx = start_idx + lines if lines else end_idx
+                    content = _read_range(filepath, start_idx, end_idx, self.encoding)
+                    if content is not None:
+                        record.update(cache="stream", bytes_read=sum(map(len, content)))
+            disk_cache_key = None
+            if content is None:
+                if not hit:
+                    source = file_cache if self.rev is None else GitRepository.for_path(filepath)
+                    misses = source.misses
+                    if self.rev is None:
+                        cached = file_cache.get(filepath, self.encoding)
+                    else:
+                        cached = source.get(filepath, self.rev, self.encoding)
+                    hit = source.misses == misses
+                record.update(cache="hit" if hit else "miss", bytes_read=0 if hit else cached.size)
+                # verbatim includes are cheaper than reading from the disk cache
+                if disk_cache is not None and not self.verbatim:
+                    if self.infer_lang:  # inferred language depends on pygments being available
+                        options["use_pygments"] = _pygments_available()
+                    disk_cache_key = disk_cache.key(options, cached.digest)
+                    rendered = disk_cache.get(disk_cache_key)
+                    if rendered is not None:
+                        record.update(cache="disk")
+                        return rendered
+            record.phase("read")
+            if self.symbol:
+                try:
+                    first_lineno, _, last_lineno = cached.symbols[self.symbol]
+                except KeyError:
+                    raise NoMatchError(
+                        f"Couldn't find symbol='{self.symbol}' in {filepath}"
+                    ) from None
+                start_idx, end_idx = first_lineno - 1, last_lineno
+            if self.start_needle:
+                start_line = _select_match(
+                    cached.find(self.start_needle),
+                    self.start_match_occurrence,
+                    self.start_option,
+                    self.start_value,
+                    filepath,
+                )
+                start_idx = start_line + self.start_offset
+            if self.end_needle and not (self.start_needle and lines):
+                # only consider lines after the line matched by start_match
+                matches = cached.find(self.end_needle)
+                matches = matches[
+                    bisect.bisect_right(matches, start_line) if self.start_needle else 0 :
+                ]
+                end_line = _select_match(
+                    matches, self.end_match_occurrence, self.end_option, self.end_value, filepath
+                )
+                end_idx = end_line + self.end_offset + (1 if self.include_end_match else 0)
+            if lines:
+                end_idx = start_idx + lines
+            merged = None
+            if self.ranges:
+                merged = _merge_ranges(
+                    [self._resolve_range(cached, bounds, filepath) for bounds in self.ranges]
+                )
+                if merged:
+                    start_idx, end_idx = merged[0][0], merged[-1][1]
+
+            if cached is not None:
+                included = range(len(cached.lines))[start_idx:end_idx]
+            record.update(
+                lines_scanned=(
+                    len(cached.lines)
+                    if self.start_needle or self.end_needle
+                    else len(content if cached is None else included)
+                )
             )
-            suffix_offset += 1
-
-        if replace_notice and has_replaced_characters:
-            if not content.endswith("\n"):
-                content += "\n"
-            content += (
-                REPLACE_NOTICE_TEMPLATE % ", ".join(f"{orig} --> {repl}" for orig, repl in replace)
-                if replace_notice is True
-                else replace_notice
+            record.phase("match")
+            if cached is not None:
+                if self.verbatim:
+                    rendered = self._render_verbatim(cached, included)
+                    if rendered is not None:
+                        return rendered
+                if merged is not None:
+                    content = self._join_ranges(cached, merged) if merged else []
+                else:
+                    content = list(cached.lines[start_idx:end_idx])
+
+            if not content:
+                if self.raise_errors and not self.silence_errors:
+                    raise ValueError("no content to include")
+                elif self.silence_errors:
+                    return ""
+                else:
+                    return ERROR_NOTICE_TEMPLATE % "no content to include"
+
+            if self.substitutions is not None:
+                pattern, substitutes = self.substitutions
+                substituted = set()
+
+                def substitute(match):
+                    substituted.add(match.group())
+                    return substitutes[match.group()]
+
+                content = [pattern.sub(substitute, line) for line in content]
+                escape = [esc for esc in escape if esc in substituted]
+                replace = [
+                    (orig, repl)
+                    for orig, repl in replace
+                    if orig in substituted and substitutes[orig] == repl
+                ]
+                has_escaped_characters, has_replaced_characters = bool(escape), bool(replace)
+
+            if dedent is True and content:
+                dedent = len(content[0].rstrip()) - len(content[0].strip())
+
+            if self.add_heading_levels:
+                levels = self.add_heading_levels * "#"
+                content = [levels + c if c.startswith("#") else c for c in content]
+
+            if not self.keep_trailing_whitespace:
+                content[-1] = content[-1].rstrip()
+
+            if self.suffix:
+                if not content[-1].endswith("\n"):
+                    content[-1] += "\n"
+                content[-1] += f"{self.suffix}\n"
+
+            record.phase("transform")
+            if self.infer_lang:
+                lang = _infer_code_language(filepath, "".join(content))
+            record.phase("language")
+
+            if lang is not None and self.highlight:
+                if self.linenos and merged and len(merged) > 1:
+                    # pygments can only number consecutive lines
+                    raise ValueError("linenos cannot be used with several separate ranges")
+                linenostart = (
+                    _line_range(start_idx, end_idx, cached, filepath)[0] if self.linenos else 0
+                )
+                # dedent now, as highlighted HTML must not be dedented
+                code_text = "".join(line[dedent:] for line in content)
+                content = list(_split_lines(_highlight(code_text, lang, linenostart)))
+                dedent = 0
+            elif lang is not None:
+                content.insert(0, f"{self.code_fence_marker}{lang}\n")
+                if not content[-1].endswith("\n"):
+                    content[-1] += "\n"
+                content.append(f"{self.code_fence_marker}")
+                prefix_offset += 1
+                suffix_offset += 1
+
+            if self.raw:
+                if not content[-1].endswith("\n"):
+                    content[-1] += "\n"
+                content = ["{% raw %}\n", *content, "{% endraw %}"]
+                prefix_offset += 1
+                suffix_offset += 1
+
+            # only dedent actual content, not prefix and suffix inserted by this macro
+            indent = self.indent
+            content = "".join(
+                [
+                    (indent if i > 0 or self.indent_first else "")
+                    + line[dedent if prefix_offset <= i < len(content) - suffix_offset else None :]
+                    for i, line in enumerate(content)
+                ]
             )
-            suffix_offset += 1
 
-        if caption and lang is not None:
-            if not content.endswith("\n"):
-                content += "\n"
+            if self.escape_notice and has_escaped_characters:
+                if not content.endswith("\n"):
+                    content += "\n"
+                content += (
+                    ESCAPE_NOTICE_TEMPLATE if self.escape_notice is True else self.escape_notice
+                ) % (", ".join(f"` {e} `" for e in escape))
+                suffix_offset += 1
+
+            if self.replace_notice and has_replaced_characters:
+                if not content.endswith("\n"):
+                    content += "\n"
+                content += (
+                    REPLACE_NOTICE_TEMPLATE
+                    % ", ".join(f"{orig} --> {repl}" for orig, repl in replace)
+                    if self.replace_notice is True
+                    else self.replace_notice
+                )
+                suffix_offset += 1
+
+            if self.caption and lang is not None:
+                if not content.endswith("\n"):
+                    content += "\n"
+
+                start_lineno, end_lineno = _line_range(start_idx, end_idx, cached, filepath)
+                content += _render_caption(
+                    self.caption,
+                    filepath,
+                    start_lineno,
+                    end_lineno,
+                    [(a + 1, b) for a, b in merged] if merged and len(merged) > 1 else None,
+                )
+                suffix_offset += 1
+
+            if disk_cache_key is not None:
+                disk_cache.set(disk_cache_key, content)
+            record.phase("render")
+            return content
+
+        except Exception as e:
+            record.update(error=f"{e.__class__.__name__}: {e}")
+            return _error_result(e, self.raise_errors, self.silence_errors)
+        finally:
+            record.finish()
+
+    def _render_glob(self, pattern: str) -> str:
+        """Include all files matching *pattern*, reading them concurrently."""
+        paths = sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+        if not paths:
+            error = NoMatchError(f"Couldn't find any files matching '{pattern}'")
+            return _error_result(error, self.raise_errors, self.silence_errors)
+        page = dependencies.page
+
+        def render(path: str) -> str:
+            dependencies.page = page  # record dependencies for the page of the calling thread
+            return self.render(path)
+
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(min(GLOB_MAX_WORKERS, len(paths))) as executor:
+            rendered = list(executor.map(render, paths))
+        separator = "\n\n" + ("" if self.indent_first else self.indent)
+        return separator.join(content for content in rendered if content)
+
+    def _resolve_range(
+        self, cached: _CachedFile, bounds: tuple[int | str | None, int | str | None], filepath
+    ) -> tuple[int, int] | None:
+        """Return indices of first and (exclusive) last line of a range of *ranges*."""
+        start, end = bounds
+        if isinstance(start, str):
+            needle = _match_option("ranges", start, "", self.match_mode)[2]
+            start_idx = _select_match(cached.find(needle), 1, "ranges", start, filepath)
+        else:
+            start_idx = 0 if start is None else (start - 1 if start > 0 else start)
+        start_idx = range(len(cached.lines))[start_idx:].start
+        if isinstance(end, str):
+            needle = _match_option("ranges", end, "", self.match_mode)[2]
+            matches = cached.find(needle)
+            matches = matches[bisect.bisect_right(matches, start_idx) :]
+            end_idx = _select_match(matches, 1, "ranges", end, filepath)
+            end_idx += 1 if self.include_end_match else 0
+        else:
+            end_idx = end
+        included = range(len(cached.lines))[start_idx:end_idx]
+        return (included.start, included.stop) if included else None
+
+    def _join_ranges(self, cached: _CachedFile, merged: list[tuple[int, int]]) -> list[str]:
+        """Return lines of all *merged* ranges, separated by elisions."""
+        first = cached.lines[merged[0][0]]
+        # indent elisions like the first line, so they are dedented like the other lines
+        indentation = first[: len(first) - len(first.lstrip(" \t"))]
+        elision = f"{indentation}{self.elision}\n"
+        content = []
+        for a, b in merged:
+            if content and self.elision:
+                content.append(elision)
+            content.extend(cached.lines[a:b])
+        return content
 
-            # lines in file start with 1
-            start_lineno = start_idx + 1
-            end_lineno = end_idx if end_idx is not None else None
-            # indices might be negative
-            if start_lineno < 0:
-                start_lineno = len(original_content) + start_lineno
-            if end_lineno is not None and end_lineno < 0:
-                end_lineno = len(original_content) + end_lineno
+    def _render_verbatim(self, cached: _CachedFile, included: range) -> str | None:
+        """Return *included* lines as a slice of the cached text.
 
-            content += _render_caption(caption, filepath, start_lineno, end_lineno)
-            suffix_offset += 1
+        Returns:
+            the included text or `None`, if there are no lines in range or they need to be
+            dedented
+        """
+        if not included:
+            return None
+        first = cached.lines[included.start]
+        if self.dedent is True and len(first.rstrip()) != len(first.strip()):
+            return None
+        offsets = cached.offsets
+        text = cached.text[offsets[included.start] : offsets[included.stop]]
+        if not self.keep_trailing_whitespace:
+            last = text.rfind("\n", 0, len(text) - 1) + 1
+            text = text[:last] + text[last:].rstrip()
+        return text
 
-        return content
 
-    except Exception as e:
-        if raise_errors and not silence_errors:
-            raise e
-        return (
-            ""
-            if silence_errors
-            else ERROR_NOTICE_TEMPLATE % (f"{e.__class__.__name__}" + (f": {e}" if f"{e}" else ""))
-        )
+_GLOB_CHARACTERS = re.compile(r"[*?[]")
+
+GLOB_MAX_WORKERS = 16
+"""Maximum number of threads reading files matched by a glob pattern."""
+
+
+def _range_option(bounds) -> tuple[int | str | None, int | str | None]:
+    """Validate an item of the *ranges* option."""
+    try:
+        start, end = bounds
+    except (TypeError, ValueError):
+        raise ValueError(f"ranges must be (start, end) pairs, not {bounds!r}") from None
+    for bound in (start, end):
+        if bound is not None and (isinstance(bound, bool) or not isinstance(bound, (int, str))):
+            raise ValueError(f"range bounds must be line numbers, text or None, not {bound!r}")
+    return start, end
+
+
+def _merge_ranges(ranges: list[tuple[int, int] | None]) -> list[tuple[int, int]]:
+    """Sort and merge overlapping and adjacent *ranges* (skipping empty ones)."""
+    merged = []
+    for a, b in sorted(r for r in ranges if r is not None):
+        if merged and a <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(b, merged[-1][1]))
+        else:
+            merged.append((a, b))
+    return merged
+
+
+_warned: set[str] = set()
+_warned_lock = threading.Lock()
+
+
+def _warn_once(message: str, category: type[Warning]):
+    """Emit warning *message* only the first time (warnings are not meant for hot code paths).
+
+    The warning is attributed to the first caller outside of this module.
+    """
+    with _warned_lock:
+        if message in _warned:
+            return
+        _warned.add(message)
+    frame, stacklevel = sys._getframe(1), 2
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame, stacklevel = frame.f_back, stacklevel + 1
+    warn(message, category, stacklevel=stacklevel)
+
+
+def _error_result(error: Exception, raise_errors: bool, silence_errors: bool) -> str:
+    """Raise *error* or return what to include instead, as configured."""
+    if raise_errors and not silence_errors:
+        raise error
+    return (
+        ""
+        if silence_errors
+        else ERROR_NOTICE_TEMPLATE
+        % (f"{error.__class__.__name__}" + (f": {error}" if f"{error}" else ""))
+    )
+
+
+MATCH_MODES = ("contains", "startswith", "line")
+
+
+def _match_option(
+    which: str, match: str, regex: str, match_mode: str
+) -> tuple[str, str, str | re.Pattern]:
+    """Return the option used to find the *which* line ("start" or "end").
+
+    Returns:
+        option name, option value and text or compiled pattern to pass to
+        [find][includex._CachedFile.find] (empty if no option was given)
+    """
+    if match and regex:
+        raise ValueError(f"{which}_match and {which}_regex cannot be used together")
+    if match_mode not in MATCH_MODES:
+        raise ValueError(f"match_mode must be one of {', '.join(MATCH_MODES)}")
+    if regex:
+        return f"{which}_regex", regex, _compile_pattern(regex)
+    if match and match_mode != "contains":
+        return f"{which}_match", match, _compile_pattern(match, match_mode)
+    return f"{which}_match", match, match
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_pattern(pattern: str, match_mode: str | None = None) -> re.Pattern:
+    """Compile *pattern* to match lines of a whole text.
+
+    If *match_mode* is given, *pattern* is not a regular expression but literal text to match
+    according to *match_mode*.
+    """
+    if match_mode == "startswith":
+        pattern = r"^[ \t]*" + re.escape(pattern)
+    elif match_mode == "line":
+        pattern = r"^[ \t]*" + re.escape(pattern) + r"[ \t]*$"
+    return re.compile(pattern, re.MULTILINE)
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_substitutions(
+    escape: tuple[str, ...], replace: tuple[tuple[str, str], ...]
+) -> tuple[re.Pattern, dict[str, str]] | None:
+    """Compile all substitutions into a single pattern, so they can be applied in one pass.
+
+    Longer substrings take precedence over shorter ones starting at the same position. If a
+    substring is given multiple times, its first substitution is used, escapes first.
+
+    Returns:
+        pattern matching any substring to be substituted and map of substrings to substitutes
+    """
+    substitutes = {}
+    for esc in escape:
+        substitutes.setdefault(esc, "\\" + esc)
+    for orig, repl in replace:
+        substitutes.setdefault(orig, repl)
+    substitutes.pop("", None)
+    if not substitutes:
+        return None
+    pattern = re.compile("|".join(map(re.escape, sorted(substitutes, key=len, reverse=True))))
+    return pattern, substitutes
+
+
+def _select_match(
+    matches: tuple[int, ...], occurrence: int, option: str, value: str, filepath: pathlib.Path
+) -> int:
+    """Return index of the line that is the *occurrence*th match (one-based, may be negative)."""
+    if occurrence == 0:
+        raise ValueError(f"{option}_occurrence must not be 0")
+    try:
+        return matches[occurrence - 1 if occurrence > 0 else occurrence]
+    except IndexError:
+        raise NoMatchError(
+            f"Couldn't find match for {option}='{value}'"
+            + (f" (occurrence {occurrence})" if occurrence != 1 else "")
+            + f" in {filepath}"
+        ) from None
+
+
+def _pygments_available() -> bool:
+    global use_pygments
+    if use_pygments is None:
+        try:
+            import pygments  # noqa: F401
+        except ImportError:  # pragma: no cover
+            use_pygments = False
+        else:
+            use_pygments = True
+    return use_pygments
 
 
 def _infer_code_language(filepath: str | pathlib.Path, text: str) -> str:
-    if use_pygments:
+    root, extension = os.path.splitext(filepath)
+    if extension in COMPRESSION_SUFFIXES:
+        filepath = root
+    has_pygments = _pygments_available()
+    if has_pygments:
         lang = _infer_code_language_pygments(filepath, text)
-    if not use_pygments or lang is None:  # fallback in case pygments failed to guess lang
+    if not has_pygments or lang is None:  # fallback in case pygments failed to guess lang
         lang = _infer_code_language_file_extension(filepath)
     return lang.lower()
 
 
 def _infer_code_language_pygments(filepath: str | pathlib.Path, text: str) -> str | None:
-    """Infer language using pygments based on filename or content."""
+    """Infer language using pygments based on filename or content.
+
+    Content is only considered if multiple lexers claim the filename.
+    """
+    filename = os.path.basename(filepath)
+    lexers = _pygments_lexers_for_filename(filename)
+    if len(lexers) == 1:
+        return lexers[0].lower()
+    return _guess_code_language_pygments(filename, text[:LANGUAGE_SAMPLE_SIZE])
+
+
+@functools.lru_cache(maxsize=256)
+def _guess_code_language_pygments(filename: str, sample: str) -> str | None:
+    from pygments.lexers import guess_lexer_for_filename
+    from pygments.util import ClassNotFound
+
     try:
-        return guess_lexer_for_filename(filepath, text).name.lower()
+        return guess_lexer_for_filename(filename, sample).name.lower()
     except ClassNotFound:
         return None
 
 
+@functools.lru_cache(maxsize=None)
+def _pygments_filename_table() -> tuple[dict[str, set[str]], list[tuple[str, str]]]:
+    """Map filename patterns of all pygments lexers to lexer names.
+
+    Like `guess_lexer_for_filename`, alias filename patterns (e.g. `*.html` of template
+    languages) are included as well, so such files are recognized as ambiguous.
+
+    Returns:
+        lexer names for exact filenames and simple extension patterns (e.g. `*.py`), as well as
+        `(pattern, lexer name)` for all other patterns (e.g. `*.php[345]`)
+    """
+    # alias filename patterns are only known by the lexer classes, which need to be loaded
+    from pygments.lexers import _iter_lexerclasses
+
+    table, other_patterns = collections.defaultdict(set), []
+    for lexer in _iter_lexerclasses():
+        name = lexer.name
+        for pattern in (*lexer.filenames, *lexer.alias_filenames):
+            stem = pattern[1:] if pattern.startswith("*.") else pattern
+            if any(c in stem for c in "*?["):
+                other_patterns.append((pattern, name))
+            else:
+                table[pattern].add(name)
+    return dict(table), other_patterns
+
+
+@functools.lru_cache(maxsize=1024)
+def _pygments_lexers_for_filename(filename: str) -> tuple[str, ...]:
+    """Return names of all lexers with a filename pattern matching *filename*."""
+    table, other_patterns = _pygments_filename_table()
+    lexers = set(table.get(filename, ()))
+    for i, c in enumerate(filename):
+        if c == ".":
+            lexers.update(table.get("*" + filename[i:], ()))
+    # pygments matches case-sensitive, so fnmatchcase is used here as well
+    lexers.update(
+        name for pattern, name in other_patterns if fnmatch.fnmatchcase(filename, pattern)
+    )
+    return tuple(sorted(lexers))
+
+
 def _infer_code_language_file_extension(filepath: str | pathlib.Path) -> str:
     _, file_extension = os.path.splitext(filepath)
     file_extension = file_extension[1:].lower()
     return CODE_EXTENSION_TO_LANGUAGE.get(file_extension, file_extension)
 
 
-def _render_caption(caption, filepath: pathlib.Path, start=0, end=0):
+def _line_range(
+    start_idx: int, end_idx: int | None, cached: _CachedFile | None, filepath: pathlib.Path
+) -> tuple[int, int | None]:
+    """Return line numbers of first and last included line (`None` for open end)."""
+    # lines in file start with 1
+    start_lineno = start_idx + 1
+    end_lineno = end_idx if end_idx is not None else None
+    # indices might be negative
+    if start_lineno < 0 or (end_lineno is not None and end_lineno < 0):
+        line_count = len(cached.lines) if cached is not None else _count_lines(filepath)
+        if start_lineno < 0:
+            start_lineno = line_count + start_lineno
+        if end_lineno is not None and end_lineno < 0:
+            end_lineno = line_count + end_lineno
+    return start_lineno, end_lineno
+
+
+HIGHLIGHT_CACHE_SIZE = 1024
+"""Number of highlighted code blocks kept in memory."""
+
+_highlight_cache: collections.OrderedDict[tuple[str, str, int], str] = collections.OrderedDict()
+_highlight_lock = threading.Lock()
+
+
+def _highlight(text: str, lang: str, linenostart: int = 0) -> str:
+    """Return *text* highlighted as HTML by pygments, numbering lines from *linenostart*.
+
+    Results are cached by a hash of *text*, *lang* and *linenostart* (`0` for no line numbers).
+    """
+    key = (hashlib.sha256(_utf8(text)).hexdigest(), lang, linenostart)
+    with _highlight_lock:
+        html = _highlight_cache.get(key)
+        if html is not None:
+            _highlight_cache.move_to_end(key)
+            return html
+
+    from pygments import highlight
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name
+    from pygments.lexers.special import TextLexer
+    from pygments.util import ClassNotFound
+
+    try:
+        lexer = get_lexer_by_name(lang) if lang else TextLexer()
+    except ClassNotFound:
+        lexer = TextLexer()
+    formatter = HtmlFormatter(
+        linenos="table" if linenostart else False, linenostart=linenostart or 1, wrapcode=True
+    )
+    html = highlight(text, lexer, formatter)
+    with _highlight_lock:
+        _highlight_cache[key] = html
+        if len(_highlight_cache) > HIGHLIGHT_CACHE_SIZE:
+            _highlight_cache.popitem(last=False)
+    return html
+
+
+def _render_caption(caption, filepath: pathlib.Path, start=0, end=0, ranges=None):
+    if ranges:  # several ranges of (first line, last line)
+        return (CAPTION_TEMPLATE if caption is True else caption) % dict(
+            filepath=filepath,
+            filename=filepath.name,
+            line=", lines " + ", ".join(f"{a}-{b}" if b > a else f"{a}" for a, b in ranges),
+        )
     if end is None:  # open end inclusion
         end_line_str = "-"
     elif end > start:  # range inclusion
@@ -354,26 +2208,238 @@ def _render_caption(caption, filepath: pathlib.Path, start=0, end=0):
 def show_and_tell(
     command, lang="py", output_lang="txt", render_result=False, alt_code_fences=True
 ):  # pragma: no cover
-    original_command = command
-    if alt_code_fences:
-        command = f"""{command[:-1]}, alt_code_fences={alt_code_fences})"""
-    result = eval(
-        command,
-        dict(
-            includex=includex,
-        ),
+    result = eval(_compile_command(command, bool(alt_code_fences)), dict(includex=includex))
+    shown = result.replace(
+        _FENCE_PLACEHOLDER, "'''" if alt_code_fences is True else str(alt_code_fences)
     )
     rv = (
-        f"```{{ .{lang} .show_and_tell_command }}\n{original_command}\n```\n"
-        f'\n```{{ .{output_lang} .show_and_tell_result title="Result" }}\n{result}\n```'
+        f"```{{ .{lang} .show_and_tell_command }}\n{command}\n```\n"
+        f'\n```{{ .{output_lang} .show_and_tell_result title="Result" }}\n{shown}\n```'
     )
     if render_result:
         # if the result shall be rendered, we need proper code fences
-        if alt_code_fences:
-            result = eval(original_command, dict(includex=includex))
-        rv += f"\n\n---\n\n{result}\n\n---\n"
+        rv += f"\n\n---\n\n{result.replace(_FENCE_PLACEHOLDER, '```')}\n\n---\n"
     return rv
 
 
+_FENCE_PLACEHOLDER = "\x00fence\x00"
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_command(command: str, alt_code_fences: bool):
+    """Compile *command* once, so it can be evaluated by [show_and_tell][includex.show_and_tell].
+
+    If *alt_code_fences* is set, a placeholder is passed as `alt_code_fences` to the call, which
+    can be replaced by the actual code fences afterwards. This way, the command only needs to be
+    evaluated once to show the result as text and render it.
+    """
+    tree = ast.parse(command, mode="eval")
+    call = tree.body
+    if (
+        alt_code_fences
+        and isinstance(call, ast.Call)
+        and not any(keyword.arg == "alt_code_fences" for keyword in call.keywords)
+    ):
+        call.keywords.append(
+            ast.keyword(arg="alt_code_fences", value=ast.Constant(_FENCE_PLACEHOLDER))
+        )
+    return compile(ast.fix_missing_locations(tree), "<show_and_tell>", "eval")
+
+
+_MACRO_EXPRESSION = re.compile(r"\{\{-?(.*?)-?\}\}", re.DOTALL)
+
+prerendered: dict[str, str] = {}
+"""Results of calls to [includex][includex.includex] evaluated by
+[prerender][includex.prerender], by [_call_key][includex._call_key]."""
+
+
+def prerender(paths, max_workers: int | None = None) -> dict[str, str]:
+    """Evaluate calls to [includex][includex.includex] found in *paths* in parallel.
+
+    Only calls with literal arguments (e.g. `{{ includex("file.py", lines=3) }}`) are found,
+    other calls (and calls that fail) are evaluated during rendering as usual, like all calls
+    in pages that cannot be read as UTF-8.
+
+    Args:
+        paths: markdown files to scan
+        max_workers: number of processes (default: number of CPUs)
+
+    Returns:
+        rendered includes by [_call_key][includex._call_key]
+    """
+    calls = {}
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue  # prerendering is only an optimization, so it must not fail the build
+        for args, kwargs in _scan_calls(text):
+            calls.setdefault(_call_key(args, kwargs), (args, kwargs))
+    if len(calls) < 2:  # not worth starting processes
+        return {}
+    import concurrent.futures
+    import multiprocessing
+
+    # forking would copy locks held by other threads (e.g. of watchers or `mkdocs serve`)
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=context) as executor:
+        results = executor.map(_prerender_call, calls.values(), chunksize=16)
+        return {key: result for key, result in zip(calls, results) if result is not None}
+
+
+def _scan_calls(text: str):
+    """Yield arguments of all calls to `includex` with literal arguments in macros in *text*."""
+    for match in _MACRO_EXPRESSION.finditer(text):
+        try:
+            call = ast.parse(match.group(1).strip(), mode="eval").body
+            if not (isinstance(call, ast.Call) and getattr(call.func, "id", None) == "includex"):
+                continue
+            args = tuple(ast.literal_eval(arg) for arg in call.args)
+            kwargs = {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords}
+        except (SyntaxError, ValueError):
+            continue
+        if None not in kwargs:  # `**kwargs`
+            yield args, kwargs
+
+
+def _call_key(args: tuple, kwargs: dict) -> str:
+    """Return key identifying a call by its arguments."""
+    return repr((args, sorted(kwargs.items())))
+
+
+def _prerender_call(call: tuple[tuple, dict]) -> str | None:
+    args, kwargs = call
+    try:
+        return includex(*args, **kwargs)
+    except Exception:
+        return None
+
+
+@functools.wraps(includex)
+def _includex_macro(*args, **kwargs):
+    # registered as `includex` with mkdocs-macros, answers prerendered calls from the table
+    if prerendered:
+        result = prerendered.get(_call_key(args, kwargs))
+        if result is not None:
+            filepath = str(args[0] if args else kwargs["filepath"])
+            if _GLOB_CHARACTERS.search(filepath) and not os.path.exists(filepath):
+                # record the included files, not the pattern (like IncludeSpec.render)
+                paths = [p for p in glob.glob(filepath, recursive=True) if os.path.isfile(p)]
+            else:
+                paths = [filepath]
+            for path in paths:
+                dependencies.add(_split_archive_path(path)[0])
+            return result
+    return includex(*args, **kwargs)
+
+
+MANIFEST_WINDOW_PER_JOB = 4
+"""Number of includes of a manifest rendered ahead per thread of the command line interface."""
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Render includes listed in a manifest and write results as JSON lines.
+
+    Each include of the manifest is an object with a `filepath` and any other arguments of
+    [includex][includex.includex] (and an optional `id`, which is passed through). Manifests
+    are either JSON (a list of includes or an object with an `include` list), TOML (an
+    `[[include]]` array of tables) or JSON lines (one include per line, e.g. streamed to stdin).
+
+    For each include, a line with its `id`, `filepath` and either the rendered `content` or an
+    `error` is written, in the order of the manifest.
+
+    Returns:
+        exit code, which is 1 if any include failed
+    """
+    import argparse
+    import concurrent.futures
+
+    parser = argparse.ArgumentParser(
+        prog="python -m includex", description=main.__doc__.split("\n")[0]
+    )
+    parser.add_argument("manifest", nargs="?", default="-", help="manifest file (default: stdin)")
+    parser.add_argument(
+        "--format",
+        choices=("json", "toml", "jsonl"),
+        help="format of manifest (default: by file extension, jsonl for stdin)",
+    )
+    parser.add_argument("-j", "--jobs", type=int, help="number of threads (default: CPUs)")
+    parser.add_argument("-o", "--output", help="write results to this file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.manifest == "-":
+        specs = _load_manifest(sys.stdin, args.format or "jsonl")
+    else:
+        fmt = args.format or os.path.splitext(args.manifest)[1][1:].lower()
+        binary = fmt == "toml"  # required by tomllib
+        with open(
+            args.manifest, "rb" if binary else "r", encoding=None if binary else "utf-8"
+        ) as f:
+            specs = list(_load_manifest(f, fmt))
+
+    output = sys.stdout if args.output is None else open(args.output, "w", encoding="utf-8")
+    failed = False
+
+    def write(future: concurrent.futures.Future):
+        nonlocal failed
+        result = future.result()
+        failed = failed or "error" in result
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+            # only submit a bounded number of includes ahead, so results of a manifest streamed
+            # to stdin are written while it is still read (and memory use stays bounded)
+            window = MANIFEST_WINDOW_PER_JOB * (args.jobs or os.cpu_count() or 1)
+            pending = collections.deque()
+            for spec in specs:
+                pending.append(executor.submit(_render_manifest_entry, spec))
+                while pending and (len(pending) > window or pending[0].done()):
+                    write(pending.popleft())
+            while pending:
+                write(pending.popleft())
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 1 if failed else 0
+
+
+def _load_manifest(f, fmt: str):
+    """Return includes of manifest *f* in format *fmt* (lazily for JSON lines)."""
+    if fmt == "jsonl":
+        return (json.loads(line) for line in f if line.strip())
+    if fmt == "json":
+        manifest = json.load(f)
+    elif fmt == "toml":
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            import tomli as tomllib
+        manifest = tomllib.load(f)
+    else:
+        raise ValueError(f"unknown manifest format: {fmt}")
+    return manifest["include"] if isinstance(manifest, dict) else manifest
+
+
+def _render_manifest_entry(entry: dict) -> dict:
+    kwargs = dict(entry)
+    result = {"id": kwargs.pop("id", None), "filepath": kwargs.get("filepath")}
+    try:
+        result["content"] = includex(**kwargs)
+    except Exception as e:
+        result["error"] = f"{e.__class__.__name__}: {e}"
+    return result
+
+
 class NoMatchError(Exception):
     pass
+
+
+class BinaryFileError(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
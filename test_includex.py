@@ -1,20 +1,56 @@
 #!/usr/bin/env python3
+import bz2
+import codecs
+import collections
+import concurrent.futures
+import gzip
+import io
+import json
+import lzma
 import os
 import pathlib
+import re
+import subprocess
+import sys
+import tarfile
 import tempfile
+import textwrap
+import threading
+import warnings
+import zipfile
 
 import pytest
 
 from includex import (
+    BINARY_SNIFF_BYTES,
     CAPTION_TEMPLATE,
     ERROR_NOTICE_TEMPLATE,
     ESCAPE_NOTICE_TEMPLATE,
+    LANGUAGE_SAMPLE_SIZE,
+    MANIFEST_WINDOW_PER_JOB,
     REPLACE_NOTICE_TEMPLATE,
+    BinaryFileError,
+    DependencyGraph,
+    DiskCache,
+    FileCache,
+    GitRepository,
+    IncludeSpec,
+    InotifyWatcher,
     NoMatchError,
+    PollingWatcher,
+    Profiler,
+    _call_key,
+    _includex_macro,
     _infer_code_language_file_extension,
     _infer_code_language_pygments,
+    _pygments_lexers_for_filename,
     _render_caption,
+    _scan_calls,
+    create_watcher,
     includex,
+    main,
+    prerender,
+    show_and_tell,
 )
 
 content = """# Header
@@ -164,6 +200,23 @@ def test_replace(testfile, replace, replace_notice):
     assert returned == expected
 
 
+def test_substitutions_single_pass(testfile):
+    """Substituted text is not substituted again by subsequent substitutions."""
+    args = dict(start_match="```py", lines=1, escape=["`"], replace=[("`", "'"), ("\\", "/")])
+    assert includex(testfile, **args, escape_notice=False) == "\\`\\`\\`py"
+    args = dict(start_match="!!!", lines=1, replace=[("!", "!!"), ("!!!", "?")])
+    assert includex(testfile, **args) == '? example "Example"'
+
+
+def test_substitution_notices_list_substituted_only(testfile):
+    args = dict(start_match="```py", lines=1, escape=["`", "*"], replace=[("py", "js"), ("!", "?")])
+    expected = "\\`\\`\\`js\n" + ESCAPE_NOTICE_TEMPLATE % "` ` `"
+    expected += "\n" + REPLACE_NOTICE_TEMPLATE % "py --> js"
+    returned = includex(testfile, **args, replace_notice=True)
+    print_debug(expected, returned)
+    assert returned == expected
+
+
 def test_first_character_missing_issue(testfile):
     args = {"start_match": "# ", "start_offset": 1, "keep_trailing_whitespace": True}
     expected = "\n".join(content.split("\n")[1:])
@@ -395,6 +448,20 @@ def test_infer_language_no_pygments(testfile, monkeypatch: pytest.MonkeyPatch):
     assert includex(testfile, code=True).startswith("```md\n")
 
 
+def test_import_does_not_import_pygments():
+    # neither pygments nor modules only needed by opt-in features (git, archives, concurrency,
+    # disk cache, profiler) are imported with includex
+    optional = ["bz2", "concurrent.futures", "gzip", "logging", "lzma", "subprocess", "tarfile"]
+    optional += ["tempfile", "zipfile"]
+    code = (
+        "import sys, includex; "
+        "assert not any(m.startswith('pygments') for m in sys.modules); "
+        f"imported = [m for m in {optional!r} if m in sys.modules]; "
+        "assert not imported, imported"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=pathlib.Path(__file__).parent)
+
+
 @pytest.mark.parametrize(
     "testfile,expected",
     [
@@ -412,6 +479,29 @@ def test_infer_code_language_pygments(path_type, testfile, expected):
     assert _infer_code_language_pygments(testfile, open(testfile).read()) == expected
 
 
+@pytest.mark.parametrize(
+    "filename,text,expected",
+    [
+        ("file.py", "<html></html>", "python"),  # unambiguous filename, content is ignored
+        ("Makefile.am", "", "makefile"),
+        ("file.h", "#include <stdio.h>\nint main(void) { return 0; }", "c"),
+        ("file.h", "@interface Foo : NSObject\n@end\n", "objective-c"),
+        ("file.h", "@interface Foo : NSObject\n@end\n" + "x" * LANGUAGE_SAMPLE_SIZE, "objective-c"),
+        ("x.html", "<p>{% if x %}{{ y }}{% endif %}</p>\n", "html+django/jinja"),  # alias filename
+        ("x.html", "<html><body><p>Hello</p></body></html>\n", "html"),
+    ],
+)
+def test_infer_code_language_pygments_ambiguous(filename, text, expected):
+    assert _infer_code_language_pygments(filename, text) == expected
+
+
+def test_pygments_lexers_for_filename():
+    assert _pygments_lexers_for_filename("file.h") == ("C", "Objective-C")
+    assert _pygments_lexers_for_filename("file.PY") == ()  # pygments matches case-sensitive
+    assert _pygments_lexers_for_filename("file.php5") == ("HTML+PHP", "PHP", "XML+PHP")
+    assert {"HTML", "HTML+Django/Jinja"} <= set(_pygments_lexers_for_filename("x.html"))
+
+
 @pytest.mark.parametrize(
     "filename, expected",
     [
@@ -429,6 +519,904 @@ def test_infer_code_language_file_extension(path_type, filename, expected):
     assert _infer_code_language_file_extension(path_type(filename)) == expected
 
 
+@pytest.mark.parametrize(
+    "kwargs, expected",
+    [
+        (dict(start_match="level", lines=1), [21]),
+        (dict(start_match="level", start_match_occurrence=2, lines=1), [22]),
+        (dict(start_match="level", start_match_occurrence=-1, lines=1), [28]),
+        (dict(start_match="## ", end_match="##", end_match_occurrence=2), range(4, 19)),
+        (dict(start_match="level", end_match="level", end_match_occurrence=-1), range(21, 28)),
+        (dict(end_match="##", end_match_occurrence=-1), range(0, 19)),
+    ],
+)
+def test_match_occurrence(testfile, kwargs, expected):
+    lines = content.split("\n")
+    expected = "\n".join(lines[i] for i in expected).rstrip()
+    returned = includex(testfile, dedent=False, **kwargs).rstrip()
+    print_debug(expected, returned)
+    assert returned == expected
+
+
+@pytest.mark.parametrize(
+    "kwargs, expected",
+    [
+        (dict(start_regex=r"^## L", lines=1), [19]),
+        (dict(start_regex=r"level$", start_match_occurrence=-1, lines=1), [28]),
+        (dict(start_regex=r"^ +- \w+ level", end_regex=r"fifth"), range(22, 25)),
+        (dict(start_match="## References", end_regex="^#+ "), range(15, 19)),
+        (dict(start_match="- ", match_mode="startswith", lines=1), [21]),
+        (dict(start_match="- fifth", match_mode="startswith", lines=1), [25]),
+        (dict(start_match="```py", end_match="```", match_mode="line"), range(8, 10)),
+        (dict(start_match="Example", match_mode="contains", lines=1), [12]),
+    ],
+)
+def test_match_regex_and_mode(testfile, kwargs, expected):
+    lines = content.split("\n")
+    expected = "\n".join(lines[i] for i in expected).rstrip()
+    returned = includex(testfile, dedent=False, **kwargs).rstrip()
+    print_debug(expected, returned)
+    assert returned == expected
+
+
+@pytest.mark.parametrize(
+    "kwargs, error",
+    [
+        (dict(start_regex="^NO MATCH"), NoMatchError),
+        (dict(start_match="level", match_mode="line"), NoMatchError),
+        (dict(start_match="level", match_mode="foo"), ValueError),
+        (dict(start_match="level", start_regex="level"), ValueError),
+    ],
+)
+def test_match_regex_and_mode_errors(testfile, kwargs, error):
+    with pytest.raises(error):
+        includex(testfile, **kwargs)
+
+
+def test_file_cache_find_pattern(testfile):
+    cached = FileCache().get(testfile)
+    assert cached.find(re.compile("level", re.MULTILINE)) == (21, 22, 23, 24, 25, 28)
+    assert cached.find(re.compile("^", re.MULTILINE)) == tuple(range(32))
+    assert cached.find(re.compile(r"line\n", re.MULTILINE)) == (30, 31)
+    assert cached.find(re.compile(r"line\nLast", re.MULTILINE)) == (30,)
+
+
+python_content = '''import functools
+
+
+class Greeter:
+    """Greets people."""
+
+    @functools.lru_cache()
+    @staticmethod
+    def greet(name):
+        return f"Hello, {name}!"
+
+    async def wait(self):
+        def inner():
+            pass
+
+
+def main():
+    print(Greeter.greet("World"))
+'''
+
+
+@pytest.mark.parametrize(
+    "kwargs, lines",
+    [
+        (dict(symbol="Greeter"), (3, 14)),
+        (dict(symbol="Greeter.greet"), (6, 10)),
+        (dict(symbol="Greeter.wait.inner", dedent=False), (12, 14)),
+    ],
+)
+def test_symbol(tmp_path, kwargs, lines):
+    testfile = tmp_path / "example.py"
+    testfile.write_text(python_content)
+    expected = "".join(python_content.splitlines(keepends=True)[lines[0] : lines[1]])
+    if kwargs.get("dedent", True):
+        expected = textwrap.dedent(expected)
+    returned = includex(testfile, **kwargs)
+    print_debug(expected.rstrip(), returned)
+    assert returned == expected.rstrip()
+
+
+def test_symbol_code_caption(tmp_path):
+    testfile = tmp_path / "example.py"
+    testfile.write_text(python_content)
+    expected = '```python\ndef main():\n    print(Greeter.greet("World"))\n```\n'
+    expected += _render_caption(True, testfile, 17, 18)
+    returned = includex(testfile, symbol="main", code=True, caption=True)
+    print_debug(expected, returned)
+    assert returned == expected
+
+
+@pytest.mark.parametrize(
+    "kwargs, error",
+    [
+        (dict(symbol="Greeter.foo"), NoMatchError),
+        (dict(symbol="inner"), NoMatchError),
+        (dict(symbol="main", start_match="def"), ValueError),
+    ],
+)
+def test_symbol_errors(tmp_path, kwargs, error):
+    testfile = tmp_path / "example.py"
+    testfile.write_text(python_content)
+    with pytest.raises(error):
+        includex(testfile, **kwargs)
+
+
+@pytest.mark.parametrize("occurrence", [7, -7])
+def test_match_occurrence_not_found(testfile, occurrence):
+    with pytest.raises(NoMatchError, match=rf".*start_match.*level.*occurrence {occurrence}"):
+        includex(testfile, start_match="level", start_match_occurrence=occurrence)
+
+
+def test_file_cache_find(testfile):
+    cached = FileCache().get(testfile)
+    assert cached.find("level") == (21, 22, 23, 24, 25, 28)
+    assert cached.find("level") is cached.find("level")
+    assert cached.find("second level\n") == (22,)
+    assert cached.find("level\n  ") == ()  # matches must not span lines
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(lines=5),
+        dict(start=3, end=8),
+        dict(start=30, lines=10),
+        dict(start=-3),
+        dict(start=-3, end=-1),
+        dict(start=-40),
+        dict(start=-5, end=40),  # cannot be streamed
+    ],
+)
+@pytest.mark.parametrize("newline", ["\n", "\r\n", "\r"])
+def test_streaming(tmp_path, monkeypatch, kwargs, newline):
+    testfile = tmp_path / "file.md"
+    testfile.write_text(content.replace("\n", newline), newline="")
+    kwargs.update(caption=True, code=True, keep_trailing_whitespace=True)
+    expected = includex(testfile, **kwargs)
+    monkeypatch.setattr("includex.STREAMING_MIN_BYTES", 0)
+    monkeypatch.setattr("includex.STREAMING_BLOCK_SIZE", 7)
+    monkeypatch.setattr("includex.file_cache", FileCache())
+    returned = includex(testfile, **kwargs)
+    print_debug(expected, returned)
+    assert returned == expected
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+@pytest.mark.parametrize(
+    "encoding, bom, kwargs",
+    [
+        ("utf-8", codecs.BOM_UTF8, dict()),
+        ("utf-16-le", codecs.BOM_UTF16_LE, dict()),
+        ("utf-16-be", codecs.BOM_UTF16_BE, dict()),
+        ("utf-32-le", codecs.BOM_UTF32_LE, dict()),
+        ("latin-1", b"", dict(encoding="latin-1")),
+        ("utf-16-le", b"", dict(encoding="utf-16-le")),
+    ],
+)
+@pytest.mark.parametrize("args", [dict(lines=3), dict(start=-3)])
+def test_encoding(tmp_path, monkeypatch, streaming, encoding, bom, kwargs, args):
+    text = content.replace("Header", "Überschrift")
+    testfile = tmp_path / "file.md"
+    testfile.write_bytes(bom + text.encode(encoding))
+    if streaming:
+        monkeypatch.setattr("includex.STREAMING_MIN_BYTES", 0)
+    expected = "\n".join(text.split("\n")[:3] if "lines" in args else text.split("\n")[-4:-1])
+    returned = includex(testfile, **kwargs, **args)
+    print_debug(expected, returned)
+    assert returned == expected
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_binary_file(tmp_path, monkeypatch, streaming):
+    testfile = tmp_path / "file.bin"
+    testfile.write_bytes(b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR" + b"\x00" * 100)
+    if streaming:
+        monkeypatch.setattr("includex.STREAMING_MIN_BYTES", 0)
+    with pytest.raises(BinaryFileError, match="binary"):
+        includex(testfile, lines=1)
+    assert includex(testfile, raise_errors=False) == ERROR_NOTICE_TEMPLATE % (
+        f"BinaryFileError: {testfile} seems to be a binary file"
+    )
+
+
+def test_binary_file_not_read(tmp_path, monkeypatch):
+    testfile = tmp_path / "file.bin"
+    testfile.write_bytes(b"\x00" * 1_000_000)
+    sizes = []
+
+    class File(io.BufferedReader):
+        def read(self, size=-1):
+            sizes.append(size)
+            return super().read(size)
+
+    monkeypatch.setattr("includex.archives.open", lambda path: File(io.FileIO(path)))
+    with pytest.raises(BinaryFileError, match="binary"):
+        FileCache().get(testfile)
+    assert sizes == [BINARY_SNIFF_BYTES]  # only the beginning is read
+
+
+@pytest.mark.parametrize("kwargs", [dict(lines=3), dict(start=4, lines=3), dict(start=-2)])
+def test_streaming_mixed_newlines(tmp_path, monkeypatch, kwargs):
+    testfile = tmp_path / "file.md"
+    testfile.write_bytes(b"1\n2\n3\r4\r\n5\r6\n7\n8\n")  # bare `\r` are line breaks as well
+    kwargs.update(caption=True)
+    expected = includex(testfile, **kwargs)
+    monkeypatch.setattr("includex.STREAMING_MIN_BYTES", 0)
+    monkeypatch.setattr("includex.STREAMING_BLOCK_SIZE", 4)
+    monkeypatch.setattr("includex.file_cache", FileCache())
+    assert includex(testfile, **kwargs) == expected
+
+
+def test_streaming_does_not_cache(tmp_path, monkeypatch):
+    testfile = tmp_path / "file.md"
+    testfile.write_text(content)
+    cache = FileCache()
+    monkeypatch.setattr("includex.STREAMING_MIN_BYTES", 0)
+    monkeypatch.setattr("includex.file_cache", cache)
+    includex(testfile, lines=3)
+    includex(testfile, start=-3)
+    assert cache.misses == 0
+    includex(testfile, start_match="Last")
+    assert cache.misses == 1
+
+
+def test_streaming_prefers_cache(tmp_path, monkeypatch):
+    testfile = tmp_path / "file.md"
+    testfile.write_text(content)
+    cache = FileCache()
+    monkeypatch.setattr("includex.file_cache", cache)
+    monkeypatch.setattr("includex.STREAMING_MIN_BYTES", 0)
+    includex(testfile, start_match="Last")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached files must not be opened")
+
+    monkeypatch.setattr("builtins.open", fail)
+    assert includex(testfile, lines=1) == "# Header"
+    assert includex(testfile, start=-1) == "Last line"
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_file_cache_hits_and_misses(testfile):
+    cache = FileCache()
+    assert cache.get(testfile).text == content
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert cache.get(testfile) is cache.get(testfile)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_file_cache_invalidation(testfile):
+    cache = FileCache()
+    cache.get(testfile)
+    with open(testfile, "a") as f:
+        f.write("Appended line\n")
+    assert cache.get(testfile).lines[-1] == "Appended line\n"
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert len(cache) == 1
+
+
+def test_file_cache_eviction(tmp_path):
+    files = [tmp_path / f"{i}.txt" for i in range(3)]
+    for file in files:
+        file.write_text("x" * 10)
+    cache = FileCache(max_bytes=25)
+    for file in files:
+        cache.get(file)
+    assert len(cache) == 2
+    assert cache.size == 20
+    cache.get(files[0])  # evicted before, needs to be read again
+    assert (cache.hits, cache.misses) == (0, 4)
+    cache.get(files[0])
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+def test_file_cache_lines(tmp_path):
+    file = tmp_path / "file.txt"
+    file.write_text("a\fb\nc\r\nd")
+    assert FileCache().get(file).lines == tuple(file.open().readlines())
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(tmp_path)
+    key = cache.key("foo", {"bar": 1})
+    assert key == DiskCache.key("foo", {"bar": 1}) != DiskCache.key("foo", {"bar": 2})
+    assert cache.get(key) is None
+    cache.set(key, "cached value")
+    assert DiskCache(tmp_path).get(key) == "cached value"
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_disk_cache_prune(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=25)
+    keys = [cache.key(i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.set(key, "x" * 10)
+        os.utime(cache._path(key), ns=(i, i))
+    cache.get(keys[0])  # marks first entry as recently used
+    cache.prune()
+    assert [cache.get(key) is not None for key in keys] == [True, False, True]
+
+
+def test_includex_disk_cache(testfile, tmp_path, monkeypatch):
+    cache = DiskCache(tmp_path)
+    monkeypatch.setattr("includex.disk_cache", cache)
+    args = dict(start_match="## ", end_match="##", code=True, caption=True)
+    expected = includex(testfile, **args)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert includex(testfile, **args) == expected
+    assert (cache.hits, cache.misses) == (1, 1)
+    includex(testfile, **args, escape=["#"])  # different options
+    assert (cache.hits, cache.misses) == (1, 2)
+    with open(testfile, "w") as f:  # different content
+        f.write(content.replace("## List", "## Lists"))
+    assert includex(testfile, **args) == expected
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_dependency_graph(testfile, monkeypatch):
+    graph = DependencyGraph()
+    monkeypatch.setattr("includex.dependencies", graph)
+    includex(testfile)  # not rendering a page, so nothing is recorded
+    assert graph.files() == set()
+
+    graph.start_page("index.md")
+    includex(testfile)
+    includex("README.md", lines=1)
+    graph.start_page("reference.md")
+    includex("foo.txt", raise_errors=False)  # missing files are recorded as well
+    graph.page = None
+
+    assert graph.files("index.md") == {testfile, os.path.abspath("README.md")}
+    assert graph.files() == {testfile, os.path.abspath("README.md"), os.path.abspath("foo.txt")}
+    assert graph.pages(testfile) == {"index.md"}
+
+    graph.start_page("index.md")  # rendering page again
+    assert graph.files("index.md") == set()
+
+
+def test_profiler(testfile, tmp_path, monkeypatch):
+    profiler = Profiler()
+    monkeypatch.setattr("includex.profiler", profiler)
+    monkeypatch.setattr("includex.file_cache", FileCache())
+    includex(testfile, start_match="```py", end_match="```", code=True)
+    includex(testfile, lines=3)
+    includex("foo.txt", raise_errors=False)
+
+    first, second, third = profiler.records
+    assert first["filepath"] == testfile
+    assert first["arguments"]["start_match"] == "```py"
+    assert (first["cache"], first["bytes_read"], first["lines_scanned"]) == (
+        "miss",
+        len(content),
+        32,
+    )
+    assert (second["cache"], second["bytes_read"], second["lines_scanned"]) == ("hit", 0, 3)
+    assert third["error"].startswith("FileNotFoundError")
+    assert first["time"] >= sum(first["phases"].values()) > 0
+
+    report = profiler.report()
+    assert report["calls"] == 3
+    assert profiler.slowest(1) == [max(profiler.records, key=lambda record: record["time"])]
+    profiler.write(tmp_path / "profile.json")
+    assert json.loads((tmp_path / "profile.json").read_text())["calls"] == 3
+
+
+@pytest.mark.parametrize("alt_code_fences", [True, "~~~", False])
+def test_show_and_tell(testfile, monkeypatch, alt_code_fences):
+    calls = []
+
+    def counting_includex(*args, **kwargs):
+        calls.append(kwargs)
+        return includex(*args, **kwargs)
+
+    monkeypatch.setattr("includex.includex", counting_includex)
+    command = f"includex({testfile!r}, start_match='print', lines=1, code='py')"
+    returned = show_and_tell(command, render_result=True, alt_code_fences=alt_code_fences)
+    assert len(calls) == 1
+
+    fence = {True: "'''", "~~~": "~~~", False: "```"}[alt_code_fences]
+    shown = f'{fence}py\nprint("Hello, World!")\n{fence}'
+    rendered = '```py\nprint("Hello, World!")\n```'
+    assert f'title="Result" }}\n{shown}\n```' in returned
+    assert returned.endswith(f"---\n\n{rendered}\n\n---\n")
+
+
+def test_git_revision(tmp_path):
+    def git(*args):
+        subprocess.run(["git", *args], cwd=tmp_path, check=True, capture_output=True)
+
+    git("init", "-q")
+    git("config", "user.email", "test@example.com")
+    git("config", "user.name", "Test")
+    source = tmp_path / "src" / "app.py"
+    source.parent.mkdir()
+    for version in ("1", "2"):
+        source.write_text(f"VERSION = {version}\nprint(VERSION)\n")
+        git("add", ".")
+        git("commit", "-q", "-m", f"v{version}")
+        git("tag", f"v{version}")
+    source.write_text("VERSION = 3\n")
+
+    assert includex(source, rev="v1", lines=1) == "VERSION = 1"
+    assert includex(source, rev="v2", start_match="print") == "print(VERSION)"
+    assert (
+        includex(source, rev="HEAD~1", code=True) == "```python\nVERSION = 1\nprint(VERSION)\n```"
+    )
+    assert includex(source) == "VERSION = 3"
+
+    repository = GitRepository.for_path(source)
+    misses = repository.misses
+    includex(source, rev="v1")
+    assert repository.hits > 0
+    assert repository.misses == misses
+
+    source.unlink()
+    assert includex(source, rev="v2", lines=1) == "VERSION = 2"
+    with pytest.raises(FileNotFoundError):
+        includex(tmp_path / "missing.py", rev="v1", raise_errors=True)
+
+    # requests must not be split into several by line breaks
+    with pytest.raises(ValueError, match="line breaks"):
+        includex(source, rev="v1\nv2:src/app.py")
+    assert includex(source, rev="v1", lines=1) == "VERSION = 1"
+    # an unexpected reply (here: to a stray request) restarts the process
+    process = repository._processes["--batch-check"]
+    process.stdin.write(b"v1:missing.py\n")
+    process.stdin.flush()
+    with pytest.raises(OSError, match="unexpected reply"):
+        includex(source, rev="v2")
+    assert includex(source, rev="v2", lines=1) == "VERSION = 2"
+    repository.close()
+
+
+@pytest.fixture
+def archive_content():
+    return "".join(f"line {i}\n" for i in range(1, 101))
+
+
+@pytest.mark.parametrize("name", ["examples.zip", "examples.tar", "examples.tar.gz"])
+def test_archive_member(tmp_path, archive_content, name):
+    member = tmp_path / "app" / "main.py"
+    member.parent.mkdir()
+    member.write_text(archive_content)
+    archive = tmp_path / name
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(archive, "w") as f:
+            f.write(member, "app/main.py")
+    else:
+        with tarfile.open(archive, "w:gz" if name.endswith(".gz") else "w") as f:
+            f.add(member, "app/main.py")
+
+    assert includex(f"{archive}!/app/main.py", start_match="line 42", lines=2) == (
+        "line 42\nline 43"
+    )
+    assert includex(f"{archive}!/app/main.py", start=-1, code=True) == "```python\nline 100\n```"
+    with pytest.raises(FileNotFoundError):
+        includex(f"{archive}!/app/missing.py", raise_errors=True)
+
+
+@pytest.mark.parametrize("suffix", [".gz", ".xz", ".bz2"])
+@pytest.mark.parametrize("streaming", [False, True])
+def test_compressed_file(tmp_path, monkeypatch, archive_content, suffix, streaming):
+    module = {".gz": gzip, ".xz": lzma, ".bz2": bz2}[suffix]
+    path = tmp_path / f"build.log{suffix}"
+    path.write_bytes(module.compress(archive_content.encode()))
+    cache = FileCache()
+    monkeypatch.setattr("includex.file_cache", cache)
+    if streaming:
+        monkeypatch.setattr("includex.STREAMING_MIN_BYTES", 0)
+        monkeypatch.setattr("includex.BINARY_SNIFF_BYTES", 17)  # ends within the third line
+
+    assert includex(path, start=3, lines=2) == "line 3\nline 4"
+    assert cache.misses == (0 if streaming else 1)
+    assert includex(path, start=-2, code="txt", caption=True) == (
+        f"```txt\nline 99\nline 100\n```\n*{path}, lines 99-*{{.caption}}"
+    )
+    assert includex(path, lines=1, code=True) == "```log\nline 1\n```"
+    assert cache.misses == 1  # tails of compressed files are always read in full
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+@pytest.mark.parametrize("data", [b"x\n" + b"\0" * 100, b"\0" * 100_000])
+def test_compressed_binary_file(tmp_path, monkeypatch, streaming, data):
+    path = tmp_path / "image.bin.gz"
+    path.write_bytes(gzip.compress(data))
+    if streaming:
+        monkeypatch.setattr("includex.STREAMING_MIN_BYTES", 0)
+    with pytest.raises(BinaryFileError, match="binary"):
+        includex(path, lines=1)
+
+
+def test_highlight(testfile, monkeypatch):
+    pytest.importorskip("pygments")
+    cache = collections.OrderedDict()
+    monkeypatch.setattr("includex._highlight_cache", cache)
+    html = includex(testfile, start_match="print", lines=1, code="py", highlight=True)
+    assert html.startswith('<div class="highlight"><pre><span></span><code>')
+    assert '<span class="nb">print</span>' in html
+    assert "```" not in html
+    assert includex(testfile, start_match="print", lines=1, highlight=True) == (
+        'print("Hello, World!")'  # no effect without code
+    )
+
+    numbered = includex(
+        testfile, start_match="print", lines=1, code="py", highlight=True, linenos=True
+    )
+    assert 'class="highlighttable"' in numbered
+    assert ">10</" in numbered  # numbered like in file
+    assert len(cache) == 2
+
+    includex(testfile, start_match="print", lines=1, code="py", highlight=True)
+    assert len(cache) == 2
+
+
+def test_scan_calls():
+    text = textwrap.dedent("""\
+        {{ includex("a.py", lines=3, escape=["*"]) }}
+        {{- includex('b.md', start_match="## Usage",
+                     code=True) -}}
+        {{ includex(file) }}
+        {{ show_and_tell("includex('c.md')") }}
+        {{ includex(**options) }}
+        """)
+    assert list(_scan_calls(text)) == [
+        (("a.py",), {"lines": 3, "escape": ["*"]}),
+        (("b.md",), {"start_match": "## Usage", "code": True}),
+    ]
+
+
+def test_prerender(tmp_path, testfile, monkeypatch):
+    page = tmp_path / "page.md"
+    page.write_text(
+        f"{{{{ includex({testfile!r}, lines=1) }}}}\n"
+        f"{{{{ includex({testfile!r}, start_match='print', lines=1, code='py') }}}}\n"
+        f"{{{{ includex({str(tmp_path / 'missing.md')!r}) }}}}\n"
+    )
+    other = tmp_path / "latin-1.md"
+    other.write_bytes(f"{{{{ includex({testfile!r}) }}}} \xe4\n".encode("latin-1"))
+    table = prerender([page, other, tmp_path / "missing-page.md"], max_workers=2)
+    assert len(table) == 2  # failing call is left to be evaluated during rendering
+    assert table[_call_key((testfile,), {"lines": 1})] == "# Header"
+
+    monkeypatch.setattr("includex.prerendered", {_call_key((testfile,), {"lines": 1}): "cached"})
+    assert _includex_macro(testfile, lines=1) == "cached"
+    assert _includex_macro(testfile, lines=2) == "# Header\n"
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"start": 5, "end": 8},
+        {"start": -4},
+        {"start": -40, "lines": 3},
+        {"start_match": "## Getting", "end_match": "```", "include_end_match": True},
+        {"start_match": "print", "dedent": False},
+        {"start_match": "Indented", "lines": 2},
+        {"start_match": "Indented", "lines": 2, "dedent": 1},
+        {"start": 2, "lines": 2, "keep_trailing_whitespace": True},
+        {"start": 100},
+    ],
+)
+def test_include_spec_verbatim(testfile, kwargs):
+    spec = IncludeSpec(**kwargs, raise_errors=False)
+    assert spec.verbatim == isinstance(kwargs.get("dedent", True), bool)
+    pipeline = IncludeSpec(**kwargs, raise_errors=False)
+    pipeline.verbatim = False
+    assert spec.render(testfile) == pipeline.render(testfile)
+
+
+def test_include_spec_reuse(tmp_path):
+    spec = IncludeSpec(start_match="def", lines=1, code=True)
+    assert not spec.verbatim
+    for name in ("a.py", "b.py"):
+        (tmp_path / name).write_text(f"# {name}\ndef {name[0]}():\n    pass\n")
+        assert spec.render(tmp_path / name) == f"```python\ndef {name[0]}():\n```"
+    (tmp_path / "indented.md").write_text("  a\n  b\n")
+    assert IncludeSpec(dedent=1).render(tmp_path / "indented.md") == " a\n b"
+    with pytest.raises(ValueError):
+        IncludeSpec(start_match="a", start_regex="a")
+    assert includex(tmp_path / "a.py", symbol="a", start_match="a", raise_errors=False) == (
+        ERROR_NOTICE_TEMPLATE
+        % "ValueError: symbol cannot be used together with start_match or end_match"
+    )
+
+
+def test_file_cache_watcher(tmp_path, monkeypatch):
+    class Watcher(set):
+        watch = set.add
+
+    testfile = tmp_path / "file.md"
+    testfile.write_text("before")
+    cache = FileCache()
+    cache.watcher = Watcher()
+    assert cache.get(testfile).text == "before"
+    assert str(testfile) in cache.watcher
+
+    def stat(*args, **kwargs):
+        raise AssertionError("watched files must not be checked")
+
+    with monkeypatch.context() as m:
+        m.setattr("os.stat", stat)
+        m.setattr("builtins.open", stat)
+        m.setattr("includex.file_cache", cache)
+        assert cache.get(testfile).text == "before"
+        assert includex(testfile, lines=1) == "before"  # head includes don't stream either
+    testfile.write_text("after")
+    assert cache.get(testfile).text == "before"
+    cache.invalidate(str(testfile))
+    assert cache.get(testfile).text == "after"
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watcher(tmp_path, polling):
+    changed = []
+    # changes must be noticed by `poll` (as called before each build), not only by the thread
+    watcher = PollingWatcher(changed.append, 3600) if polling else create_watcher(changed.append)
+    if not polling and not isinstance(watcher, InotifyWatcher):
+        pytest.skip("inotify is not available")
+    try:
+        watched, other = tmp_path / "watched.md", tmp_path / "other.md"
+        watched.write_text("before")
+        watcher.watch(str(watched))
+        assert str(watched) in watcher
+        other.write_text("other")
+        watched.write_text("after, which changes the size")
+        watcher.poll()
+        assert set(changed) == {str(watched)}
+
+        # changes to the target of a symbolic link in another directory are noticed as well
+        (tmp_path / "src").mkdir()
+        (tmp_path / "docs").mkdir()
+        target, link = tmp_path / "src" / "app.py", tmp_path / "docs" / "app.py"
+        target.write_text("v1")
+        link.symlink_to(os.path.join("..", "src", "app.py"))
+        watcher.watch(str(link))
+        changed.clear()
+        target.write_text("v2, which changes the size")
+        watcher.poll()
+        assert set(changed) == {str(link)}
+    finally:
+        watcher.stop()
+
+
+def test_ranges(tmp_path):
+    source = tmp_path / "app.py"
+    source.write_text(textwrap.dedent("""\
+            import os
+            import sys
+
+
+            class App:
+                def run(self):
+                    pass
+
+
+            def helper():
+                pass
+
+
+            if __name__ == "__main__":
+                App().run()
+            """))
+    ranges = [(1, 2), ("class App", "def helper"), ("if __name__", None)]
+    assert includex(source, ranges=ranges, elision="...", code="py", caption=True) == (
+        "```py\n"
+        "import os\nimport sys\n...\nclass App:\n    def run(self):\n        pass\n\n\n"
+        '...\nif __name__ == "__main__":\n    App().run()\n'
+        "```\n"
+        f"*{source}, lines 1-2, 5-9, 14-15*{{.caption}}"
+    )
+    # overlapping and adjacent ranges are merged, elisions are indented like the first line
+    assert includex(source, ranges=[(6, 7), (7, 7), (-1, None), (5, 6)], elision="...") == (
+        "class App:\n    def run(self):\n        pass\n...\n    App().run()"
+    )
+    assert includex(source, ranges=[(6, 6), (15, 15)], elision="# ...", dedent=False) == (
+        "    def run(self):\n    # ...\n    App().run()"
+    )
+    for options in (
+        dict(start_match="class"),
+        dict(start_offset=5),
+        dict(end_offset=1),
+        dict(start_match_occurrence=2),
+        dict(end_match_occurrence=-1),
+    ):
+        with pytest.raises(ValueError, match="ranges cannot be used together"):
+            includex(source, ranges=ranges, **options)
+    with pytest.raises(ValueError, match="pairs"):
+        includex(source, ranges=[1, 2])
+    with pytest.raises(NoMatchError, match="ranges='class Missing'"):
+        includex(source, ranges=[("class Missing", None)])
+    with pytest.raises(ValueError, match="no content"):
+        includex(source, ranges=[(20, None)])
+
+
+def test_ranges_linenos(tmp_path):
+    pytest.importorskip("pygments")
+    source = tmp_path / "app.py"
+    source.write_text("".join(f"x = {i}\n" for i in range(1, 11)))
+    numbered = includex(source, ranges=[(3, 4), (5, 6)], code="py", highlight=True, linenos=True)
+    assert ">3</" in numbered and ">6</" in numbered  # merged ranges are numbered like in file
+    with pytest.raises(ValueError, match="linenos cannot be used with several separate ranges"):
+        includex(source, ranges=[(1, 2), (8, 9)], code="py", highlight=True, linenos=True)
+    # without line numbers, separate ranges are fine
+    assert "x" in includex(source, ranges=[(1, 2), (8, 9)], code="py", highlight=True)
+
+
+def test_lang_deprecation_warned_once(testfile, monkeypatch):
+    monkeypatch.setattr("includex._warned", set())
+    with pytest.warns(DeprecationWarning, match="`lang` option is deprecated") as record:
+        includex(testfile, lang="md")
+    assert record[0].filename == __file__  # points to the caller, not into includex
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        includex(testfile, lang="md")
+
+
+def test_thread_safety(tmp_path, monkeypatch):
+    monkeypatch.setattr("includex.file_cache", FileCache(max_bytes=4096))  # force evictions
+    paths = []
+    for i in range(20):
+        path = tmp_path / f"file_{i}.md"
+        path.write_text(content.replace("Header", f"Header {i}"))
+        paths.append(path)
+    with zipfile.ZipFile(tmp_path / "files.zip", "w") as f:
+        f.write(paths[0], "file.md")
+    paths.append(f"{tmp_path / 'files.zip'}!/file.md")
+    variants = [
+        {},
+        {"start_match": "## Getting", "end_match": "##", "code": True, "caption": True},
+        {"start_regex": r"^- \w+", "lines": 3, "escape": ["-"], "replace": [("level", "LEVEL")]},
+        {"ranges": [(1, 3), ("## List", "- second")], "elision": "...", "indent": 2},
+        {"symbol": "missing", "raise_errors": False},
+        {"start": -5, "dedent": False, "add_heading_levels": 1},
+    ]
+    calls = [(path, kwargs) for path in paths for kwargs in variants] * 20
+    expected = [includex(path, **kwargs) for path, kwargs in calls]
+
+    barrier = threading.Barrier(16)
+
+    def run(thread):
+        barrier.wait()
+        return [includex(path, **kwargs) for path, kwargs in calls[thread::16]]
+
+    with concurrent.futures.ThreadPoolExecutor(16) as executor:
+        results = list(executor.map(run, range(16)))
+    for thread, result in enumerate(results):
+        assert result == expected[thread::16]
+
+
+def test_cli(testfile, tmp_path, monkeypatch):
+    manifest = [
+        {"id": "header", "filepath": testfile, "lines": 1},
+        {"filepath": testfile, "start_match": "print", "lines": 1, "code": "py"},
+        {"id": "missing", "filepath": str(tmp_path / "missing.md")},
+    ]
+    (tmp_path / "manifest.json").write_text(json.dumps({"include": manifest}))
+    output = tmp_path / "output.jsonl"
+    assert main([str(tmp_path / "manifest.json"), "--jobs", "2", "-o", str(output)]) == 1
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert results[0] == {"id": "header", "filepath": testfile, "content": "# Header"}
+    assert results[1]["content"] == '```py\nprint("Hello, World!")\n```'
+    assert results[2]["error"].startswith("FileNotFoundError")
+
+    (tmp_path / "manifest.jsonl").write_text("\n".join(map(json.dumps, manifest[:2])))
+    assert main([str(tmp_path / "manifest.jsonl"), "-o", str(output)]) == 0
+    assert [json.loads(line) for line in output.read_text().splitlines()] == results[:2]
+
+    (tmp_path / "manifest.toml").write_text(f"[[include]]\nfilepath = {json.dumps(testfile)}\n")
+    if sys.version_info >= (3, 11):
+        assert main([str(tmp_path / "manifest.toml"), "-o", str(output)]) == 0
+        assert json.loads(output.read_text())["content"] == includex(testfile)
+
+    # stdin is read while results are written, not all at once
+    written = io.StringIO()
+
+    def stdin():
+        for i in range(20):
+            assert written.getvalue().count("\n") >= i - MANIFEST_WINDOW_PER_JOB
+            yield json.dumps(manifest[0]) + "\n"
+
+    monkeypatch.setattr("sys.stdin", stdin())
+    monkeypatch.setattr("sys.stdout", written)
+    assert main(["--jobs", "1"]) == 0
+    assert written.getvalue().count("\n") == 20
+
+    process = subprocess.run(
+        [sys.executable, "-m", "includex"],
+        input="\n".join(json.dumps(spec) for spec in manifest[:2] * 50),
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    assert process.returncode == 0
+    lines = process.stdout.splitlines()
+    assert len(lines) == 100
+    assert [json.loads(line)["id"] for line in lines[:2]] == ["header", None]
+
+
+def test_glob(tmp_path, monkeypatch):
+    for name in ("b.yml", "a.yml", "nested/c.yml", "nested/d.txt"):
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text(f"name: {name}\n")
+    graph = DependencyGraph()
+    monkeypatch.setattr("includex.dependencies", graph)
+    graph.start_page("index.md")
+
+    assert includex(f"{tmp_path}/**/*.yml", code=True, caption=True) == "\n\n".join(
+        f"```yaml\nname: {name}\n```\n*{tmp_path / name}, lines 1-*{{.caption}}"
+        for name in ("a.yml", "b.yml", "nested/c.yml")
+    )
+    assert graph.files("index.md") == {
+        str(tmp_path / n) for n in ("a.yml", "b.yml", "nested/c.yml")
+    }
+    assert includex(tmp_path / "*.yml", indent=2) == "name: a.yml\n\n  name: b.yml"
+    # prerendered globs record the matching files as well, not the pattern
+    graph.start_page("index.md")
+    monkeypatch.setattr("includex.prerendered", {_call_key((f"{tmp_path}/*.yml",), {}): "cached"})
+    assert _includex_macro(f"{tmp_path}/*.yml") == "cached"
+    assert graph.files("index.md") == {str(tmp_path / n) for n in ("a.yml", "b.yml")}
+    with pytest.raises(NoMatchError, match="matching"):
+        includex(f"{tmp_path}/*.md")
+    assert includex(f"{tmp_path}/*.md", silence_errors=True) == ""
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for name in ("b.md", "a.txt", "api/c.md", "api/d.txt", "api/ignored/e.md"):
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text(name)
+    return tmp_path
+
+
+def test_get_files(tree):
+    from docs.macros import get_files
+
+    assert get_files(tree) == [tree / "a.txt", tree / "api", tree / "b.md"]
+    assert get_files(tree, match=".md", ignore="b") == []
+    assert get_files(tree, recursive=True, ignore="ignored") == [
+        tree / n for n in ("a.txt", "api/c.md", "api/d.txt", "b.md")
+    ]
+    # patterns without `/` match filenames, others match paths relative to the directory
+    assert get_files(tree, pattern="*.md", recursive=True) == [
+        tree / n for n in ("api/c.md", "api/ignored/e.md", "b.md")
+    ]
+    assert get_files(tree, pattern="api/*.md", recursive=True) == [tree / "api/c.md"]
+    assert get_files(tree, pattern="*.md") == [tree / "b.md"]
+
+    files = get_files(tree, recursive=True, lazy=True)
+    assert not isinstance(files, list)
+    assert next(files) == tree / "a.txt"
+
+
+def test_get_files_symlink_loop(tree):
+    from docs.macros import get_files
+
+    (tree / "api" / "loop").symlink_to(tree, target_is_directory=True)
+    (tree / "linked").symlink_to(tree / "api" / "ignored", target_is_directory=True)
+    assert get_files(tree, pattern="*.md", recursive=True) == [
+        tree / n for n in ("api/c.md", "api/ignored/e.md", "b.md", "linked/e.md")
+    ]
+
+
+def test_get_files_cache(tree, monkeypatch):
+    from docs.macros import get_files
+
+    assert get_files(tree / "api") == [tree / "api" / n for n in ("c.md", "d.txt", "ignored")]
+    with monkeypatch.context() as m:
+        m.setattr("os.scandir", None)  # unchanged directories are not listed again
+        assert get_files(tree / "api") == [tree / "api" / n for n in ("c.md", "d.txt", "ignored")]
+    (tree / "api" / "new.md").write_text("new")
+    os.utime(tree / "api", ns=(0, 0))  # modification time changes, even on coarse filesystems
+    assert get_files(tree / "api", pattern="*.md") == [tree / "api" / n for n in ("c.md", "new.md")]
+
+
 if __name__ == "__main__":
     import sys
 